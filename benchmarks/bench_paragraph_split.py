@@ -0,0 +1,66 @@
+"""
+Micro-benchmark for splitting long LLM responses into Discord embeds.
+
+Run from the repository root with: python -m benchmarks.bench_paragraph_split
+"""
+import random
+import time
+from src.jbot.helper_functions import paragraph_split, pack_embeds
+
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetuer", "adipiscing", "elit", "aenean", "commodo"]
+
+
+def make_response(length: int, seed: int = 0) -> str:
+    """
+    Builds a fake LLM response of roughly the given length. Mixes short paragraphs with paragraphs far longer
+    than a single chunk so both the paragraph packing and the sentence splitting paths are exercised.
+    """
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+
+    while total < length:
+        sentence = " ".join(rng.choices(WORDS, k=rng.randint(4, 30))) + rng.choice(".?!")
+        parts.append(sentence)
+        total += len(sentence) + 1
+
+        if rng.random() < 0.1:
+            parts.append("\n")
+        else:
+            parts.append(" ")
+
+    return "".join(parts)[:length]
+
+
+def bench(text: str, repeat: int) -> tuple[float, int, int]:
+    """
+    Returns the best time in seconds to split and pack the text, with the number of chunks and embeds made.
+    """
+    best = float("inf")
+    chunks, embeds = [], []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = paragraph_split(text)
+        embeds = pack_embeds(chunks)
+        best = min(best, time.perf_counter() - start)
+
+    return best, len(chunks), len(embeds)
+
+
+def main() -> None:
+    print(f"{'shape':>10} {'chars':>12} {'chunks':>8} {'embeds':>8} {'time (ms)':>12} {'ns/char':>10}")
+
+    for size in SIZES:
+        text = make_response(size)
+
+        # A single paragraph is the worst case for splitting on sentences
+        for shape, shaped_text in (("mixed", text), ("paragraph", text.replace("\n", " "))):
+            best, n_chunks, n_embeds = bench(shaped_text, repeat=max(1, 2_000_000 // size))
+            print(f"{shape:>10} {size:>12} {n_chunks:>8} {n_embeds:>8} {best * 1000:>12.3f} "
+                  f"{best / size * 1e9:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
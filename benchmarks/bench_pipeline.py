@@ -0,0 +1,244 @@
+"""
+End-to-end latency benchmarks for the AICharacters hot paths, run offline against local stand-in backends.
+
+Stages measured:
+- llm.prep_ask: BaseLLM._prep_ask including history trimming
+- osc.talk.*: OnScreenCharacter.talk split into LLM, TTS and OBS + playback
+- audio.process: AudioProcessor trimming, speeding up and levelling a clip of synthesized speech
+- api.*: the run_osc_api queue, from enqueueing over HTTP until a prompt has been spoken
+- split.paragraph_split: splitting and packing a long response into embeds
+
+Run from the repository root with: python -m benchmarks.bench_pipeline
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+# run_osc_api imports its packages relative to src, like it does when started from there
+sys.path.insert(0, SRC)
+
+from .fakes import FakeOpenAIServer, FakeOBSServer, FakeTTS, use_fake_tts, use_null_audio_sink
+from .stats import summarize, print_table
+from .bench_paragraph_split import make_response
+
+# Stand-ins have to be in place before any pygame or gTTS using module is imported
+use_null_audio_sink()
+use_fake_tts()
+
+import httpx
+import uvicorn
+import run_osc_api
+from onscreencharacter import OnScreenCharacter
+from onscreencharacter.audioprocessing import AudioProcessor, decode
+from src.llm import RemoteLLMManager
+from src.jbot.helper_functions import paragraph_split, pack_embeds
+
+SCENE_NAME = "Benchmark Scene"
+SOURCE_NAME = "Benchmark Source"
+
+
+def configure_env(llm: FakeOpenAIServer, obs: FakeOBSServer, queue_db: str) -> None:
+    """
+    Points the environment variables read by the onscreen characters at the stand-in servers, and the OSC API
+    queue at a throwaway database.
+    """
+    os.environ.update({
+        "AI_LLM_MODEL": "fake-model",
+        "AI_API_KEY": "fake-key",
+        "AI_API_URL": llm.url,
+        "AI_SYSTEM_MESSAGE": "You are a character in a benchmark.",
+        "AI_VERBOSE": "",
+        "AI_n_ctx": "512",
+        "OBSWS_HOST": obs.host,
+        "OBSWS_PORT": str(obs.port),
+        "OBSWS_PASSWORD": "",
+        # Every benchmark prompt comes from the same client, so it must not be rate limited
+        "AI_RATE_LIMIT_PER_MINUTE": "0",
+        "AI_CLIENT_RATE_LIMIT_PER_MINUTE": "0",
+        "AI_QUEUE_DB": queue_db,
+        # Benchmark usage must not end up in the real totals
+        "AI_USAGE_FILE": ""
+    })
+
+
+def bench_prep_ask(llm: FakeOpenAIServer, iterations: int) -> list[dict]:
+    """
+    Times _prep_ask with a small context window so the history is trimmed on almost every call.
+    """
+    manager = RemoteLLMManager("fake-model", "fake-key", llm.url, system_message="You are a benchmark.", n_ctx=256)
+    samples = []
+
+    for idx in range(iterations):
+        start = time.perf_counter()
+        manager._prep_ask(f"Prompt number {idx}, please answer it with a few sentences.")
+        samples.append(time.perf_counter() - start)
+
+        # Grow the history like a real answer would
+        manager.add_message("assistant", llm.reply)
+
+    return [summarize("llm.prep_ask", samples)]
+
+
+async def bench_talk(iterations: int) -> list[dict]:
+    """
+    Times OnScreenCharacter.talk, using the stages it reports to split the total into LLM, TTS and playback.
+    """
+    character = OnScreenCharacter(SCENE_NAME, SOURCE_NAME)
+    await character.warm_up()
+    stages: dict[str, list[float]] = {"generating": [], "synthesizing": [], "playing": [], "total": []}
+
+    for idx in range(iterations):
+        entered: dict[str, float] = {}
+
+        def on_stage(stage: str, text=None) -> None:
+            entered[stage] = time.perf_counter()
+
+        start = time.perf_counter()
+        await character.talk(f"Say something about the number {idx}.", on_stage=on_stage)
+        end = time.perf_counter()
+
+        stages["generating"].append(entered["synthesizing"] - entered["generating"])
+        stages["synthesizing"].append(entered["playing"] - entered["synthesizing"])
+        stages["playing"].append(end - entered["playing"])
+        stages["total"].append(end - start)
+
+    return [summarize(f"osc.talk.{stage}", samples) for stage, samples in stages.items()]
+
+
+def bench_audio(iterations: int, words: int = 200) -> list[dict]:
+    """
+    Times processing a clip of a few seconds of fake speech, bypassing the cache so every sample does the work.
+    """
+    import pygame
+    pygame.mixer.init()
+
+    tts = FakeTTS(" ".join(["word"] * words))
+    tts.seconds_per_word = 0.025
+    file_name = os.path.join(ROOT, "bench_audio_temp.wav")
+    tts.save(file_name)
+
+    with open(file_name, "rb") as clip:
+        samples, sample_rate = decode(clip.read())
+    os.remove(file_name)
+
+    processor = AudioProcessor()
+    timings = []
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        processor.process_samples(samples, sample_rate)
+        timings.append(time.perf_counter() - start)
+
+    return [summarize("audio.process", timings)]
+
+
+async def bench_queue(n_prompts: int, port: int = 8123) -> list[dict]:
+    """
+    Starts the OSC API, enqueues prompts from many concurrent clients and follows each job until it is spoken.
+    """
+    # The API reads characters.csv from the working directory
+    os.chdir(SRC)
+    server = uvicorn.Server(uvicorn.Config(run_osc_api.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    base_url = f"http://127.0.0.1:{port}/api"
+    enqueue_samples, wait_samples, total_samples = [], [], []
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        characters = (await client.get("/characters")).json()
+
+        async def submit(idx: int) -> str:
+            start = time.perf_counter()
+            response = await client.post(f"/{random.choice(characters)}/chat", content=f"Prompt {idx}",
+                                         headers={"Content-Type": "text/plain; charset=utf-8"})
+            enqueue_samples.append(time.perf_counter() - start)
+
+            return response.json()["Job ID"]
+
+        async def follow(job_id: str) -> None:
+            async with client.stream("GET", f"/jobs/{job_id}/events") as events:
+                async for line in events.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+
+                    job = json.loads(line[5:])
+                    if job["status"] in ("done", "failed"):
+                        wait_samples.append(job["durations"].get("queued", 0.0))
+                        total_samples.append(job["timestamps"][job["status"]] - job["timestamps"]["queued"])
+
+        start = time.perf_counter()
+        job_ids = await asyncio.gather(*(submit(idx) for idx in range(n_prompts)))
+        await asyncio.gather(*(follow(job_id) for job_id in job_ids))
+        wall_time = time.perf_counter() - start
+
+    server.should_exit = True
+    thread.join()
+    os.chdir(ROOT)
+
+    return [summarize("api.enqueue", enqueue_samples),
+            summarize("api.queue_wait", wait_samples),
+            summarize("api.end_to_end", total_samples, wall_time)]
+
+
+def bench_split(iterations: int, length: int = 20_000) -> list[dict]:
+    """
+    Times splitting a long response into chunks and packing them into embeds.
+    """
+    samples = []
+
+    for seed in range(iterations):
+        text = make_response(length, seed)
+
+        start = time.perf_counter()
+        pack_embeds(paragraph_split(text))
+        samples.append(time.perf_counter() - start)
+
+    return [summarize("split.paragraph_split", samples)]
+
+
+async def run(args: argparse.Namespace) -> list[dict]:
+    rows = bench_split(args.iterations * 10)
+
+    with FakeOpenAIServer(latency=args.llm_latency) as llm, FakeOBSServer() as obs, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        configure_env(llm, obs, os.path.join(tmp_dir, "chat_queue.db"))
+
+        rows += bench_prep_ask(llm, args.iterations)
+        rows += await bench_talk(args.iterations)
+        rows += bench_audio(args.iterations)
+        rows += await bench_queue(args.prompts)
+
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks AICharacters against local stand-in backends.")
+    parser.add_argument("--iterations", type=int, default=20, help="Samples taken for each single call stage.")
+    parser.add_argument("--prompts", type=int, default=20, help="Prompts sent through the OSC API queue.")
+    parser.add_argument("--llm-latency", type=float, default=0.02, help="Seconds the fake LLM takes to answer.")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    rows = asyncio.run(run(args))
+    print_table(rows)
+
+    if args.json_path is not None:
+        with open(args.json_path, "w", encoding="utf-8") as file:
+            json.dump(rows, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
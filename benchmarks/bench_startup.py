@@ -0,0 +1,145 @@
+"""
+Cold-start benchmarks for both entry points. Every sample starts a fresh interpreter:
+
+- startup.api: launching the OSC API until GET /api/characters answers
+- startup.bot: launching the bot until it is created with its cogs loaded (without logging in to Discord)
+
+Run from the repository root with: python -m benchmarks.bench_startup
+Exits with status 1 if the p50 of an entry point is slower than its target.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+from .fakes import FakeOpenAIServer, FakeOBSServer
+from .stats import summarize, print_table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+# Seconds each entry point may take to start, measured at the median
+API_TARGET = 1.5
+BOT_TARGET = 1.5
+
+BOT_SCRIPT = "from main import create_bot; from src.config import get_config; create_bot(get_config()); print('ready')"
+
+
+def make_env(llm: FakeOpenAIServer, obs: FakeOBSServer, queue_db: str) -> dict[str, str]:
+    """
+    Environment for the child processes, pointing the characters at the stand-in servers and the chat queue at a
+    scratch database, so the real queue and usage totals are never touched.
+    """
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")])),
+        "SDL_AUDIODRIVER": "dummy",
+        "AI_LLM_MODEL": "fake-model",
+        "AI_API_KEY": "fake-key",
+        "AI_API_URL": llm.url,
+        "AI_n_ctx": "512",
+        "OBSWS_HOST": obs.host,
+        "OBSWS_PORT": str(obs.port),
+        "OBSWS_PASSWORD": "",
+        "AI_QUEUE_DB": queue_db,
+        "AI_USAGE_FILE": "",
+        "JBOT_USAGE_FILE": ""
+    })
+
+    return env
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_api_start(env: dict[str, str], timeout: float = 30.0) -> float:
+    """
+    Starts the OSC API in a new process and times how long it takes to answer its first request.
+    """
+    port = free_port()
+    command = [sys.executable, "-m", "uvicorn", "run_osc_api:app", "--host", "127.0.0.1", "--port", str(port),
+               "--log-level", "warning"]
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=SRC, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/api/characters", timeout=1.0).status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+
+            if process.poll() is not None:
+                raise RuntimeError(f"The OSC API exited with status {process.returncode} while starting.")
+
+            time.sleep(0.005)
+
+        raise TimeoutError(f"The OSC API did not start within {timeout} seconds.")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def time_bot_start(env: dict[str, str]) -> float:
+    """
+    Creates the bot in a new process and times how long it takes until its cogs are loaded.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", BOT_SCRIPT], cwd=SRC, env=env, text=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    for line in process.stdout:
+        if line.strip() == "ready":
+            elapsed = time.perf_counter() - start
+            break
+    else:
+        raise RuntimeError(f"The bot exited with status {process.wait()} before it was created.")
+
+    process.wait()
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measures how long AICharacters takes to start.")
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts measured for each entry point.")
+    parser.add_argument("--api-target", type=float, default=API_TARGET, help="Seconds the OSC API may take.")
+    parser.add_argument("--bot-target", type=float, default=BOT_TARGET, help="Seconds the bot may take.")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    with FakeOpenAIServer() as llm, FakeOBSServer() as obs, tempfile.TemporaryDirectory() as tmp_dir:
+        env = make_env(llm, obs, os.path.join(tmp_dir, "chat_queue.db"))
+
+        rows = [summarize("startup.api", [time_api_start(env) for _ in range(args.runs)]),
+                summarize("startup.bot", [time_bot_start(env) for _ in range(args.runs)])]
+
+    print_table(rows)
+
+    missed = []
+    for row, target in zip(rows, (args.api_target, args.bot_target)):
+        row["target_ms"] = target * 1000
+        if row["p50_ms"] > row["target_ms"]:
+            missed.append(f"{row['stage']} took {row['p50_ms']:.0f} ms, the target is {row['target_ms']:.0f} ms")
+
+    if args.json_path is not None:
+        with open(args.json_path, "w", encoding="utf-8") as file:
+            json.dump(rows, file, indent=4)
+
+    if missed:
+        print("\n".join(missed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
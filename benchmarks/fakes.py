@@ -0,0 +1,259 @@
+"""
+Local stand-ins for the services AICharacters talks to, so the hot paths can be benchmarked offline:
+
+- FakeOpenAIServer: an OpenAI compatible chat completions API (including token counting and streaming)
+- FakeOBSServer: an obs-websocket v5 server that acknowledges every request
+- FakeTTS: a drop-in for gTTS that writes a short hummed clip instead of calling Google
+- use_null_audio_sink: makes pygame play into a dummy audio device
+"""
+import os
+import json
+import time
+import wave
+import threading
+import numpy as np
+from typing import Optional
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.server import serve
+
+DEFAULT_REPLY = ("Hello there! I am a stand-in for a real language model. I answer every prompt with the same few "
+                 "sentences so that benchmarks measure our own overhead. Nothing here was generated.")
+
+
+def count_tokens(messages: list[dict]) -> int:
+    """
+    Rough token count used by the fake LLM: one token per word plus a few tokens of overhead per message.
+    """
+    return sum(len(str(message.get("content", "")).split()) + 4 for message in messages)
+
+
+class FakeOpenAIServer:
+    """
+    Serves /v1/chat/completions on a background thread. Requests with max_tokens=0 are answered immediately like
+    the token counting done by the LLM managers. Other requests wait latency seconds before replying, and streamed
+    requests wait token_latency seconds between every word.
+    """
+
+    def __init__(self, reply: str = DEFAULT_REPLY, latency: float = 0.02, token_latency: float = 0.001,
+                 host: str = "127.0.0.1", port: int = 0) -> None:
+        self.reply = reply
+        self.latency = latency
+        self.token_latency = token_latency
+        self.requests = 0
+
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            # Headers and body are written separately, Nagle's algorithm would hold the body back
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                fake.requests += 1
+                prompt_tokens = count_tokens(body["messages"])
+
+                if body.get("max_tokens") == 0:
+                    self._send_json(_completion(body, "", prompt_tokens, 0))
+                elif body.get("stream"):
+                    self._stream(body, prompt_tokens)
+                else:
+                    time.sleep(fake.latency)
+                    self._send_json(_completion(body, fake.reply, prompt_tokens, len(fake.reply.split())))
+
+            def _send_json(self, payload: dict) -> None:
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, body: dict, prompt_tokens: int) -> None:
+                # Without a content length the connection is closed to mark the end of the stream
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+                time.sleep(fake.latency)
+                words = fake.reply.split(" ")
+
+                for idx, word in enumerate(words):
+                    delta = word if idx == 0 else " " + word
+                    self._send_event(_chunk(body, [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]))
+                    time.sleep(fake.token_latency)
+
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                         "total_tokens": prompt_tokens + len(words)}
+                self._send_event(_chunk(body, [], usage))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+            def _send_event(self, payload: dict) -> None:
+                self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+        return Handler
+
+
+def _completion(body: dict, content: str, prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens}
+    }
+
+
+def _chunk(body: dict, choices: list[dict], usage: Optional[dict] = None) -> dict:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": choices,
+        "usage": usage
+    }
+
+
+class FakeOBSServer:
+    """
+    Speaks enough of the obs-websocket v5 protocol for obsws_python's ReqClient: it says hello without requiring
+    authentication, identifies the client and answers every request and request batch successfully. Scene item
+    visibility is remembered so it can be read back.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.requests = 0
+        self._scene_items: dict[tuple[str, str], int] = {}
+        self._enabled: dict[int, bool] = {}
+
+        self._server = serve(self._handle, host, port)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def host(self) -> str:
+        return self._server.socket.getsockname()[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.socket.getsockname()[1]
+
+    def __enter__(self) -> "FakeOBSServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+
+    def _handle(self, websocket) -> None:
+        websocket.send(json.dumps({"op": 0, "d": {"obsWebSocketVersion": "5.0.0", "rpcVersion": 1}}))
+
+        try:
+            for raw_message in websocket:
+                message = json.loads(raw_message)
+
+                if message["op"] == 1:
+                    websocket.send(json.dumps({"op": 2, "d": {"negotiatedRpcVersion": 1}}))
+                elif message["op"] == 6:
+                    self.requests += 1
+                    websocket.send(json.dumps({"op": 7, "d": self._respond(message["d"])}))
+                elif message["op"] == 8:
+                    # Request batches are answered in one message, with a result per request in order
+                    self.requests += 1
+                    results = [self._respond({"requestId": str(idx), **request})
+                               for idx, request in enumerate(message["d"]["requests"])]
+                    websocket.send(json.dumps({"op": 9, "d": {"requestId": message["d"]["requestId"],
+                                                              "results": results}}))
+        except ConnectionClosed:
+            # Clients are not closed cleanly when the process exits
+            pass
+
+    def _respond(self, request: dict) -> dict:
+        request_type = request["requestType"]
+        data = request.get("requestData", {})
+        response = {"requestType": request_type, "requestId": request["requestId"],
+                    "requestStatus": {"result": True, "code": 100}}
+
+        if request_type == "GetSceneItemId":
+            key = (data["sceneName"], data["sourceName"])
+            item_id = self._scene_items.setdefault(key, len(self._scene_items) + 1)
+            response["responseData"] = {"sceneItemId": item_id}
+        elif request_type == "SetSceneItemEnabled":
+            self._enabled[data["sceneItemId"]] = data["sceneItemEnabled"]
+        elif request_type == "GetSceneItemEnabled":
+            response["responseData"] = {"sceneItemEnabled": self._enabled.get(data["sceneItemId"], False)}
+
+        return response
+
+
+class FakeTTS:
+    """
+    Drop-in for gTTS. Writes a clip with a hummed syllable for every word and some silence at either end, so its
+    length grows with the text like real speech would. It is a WAV file, which pygame recognizes by its contents
+    even when saved with the .mp3 name gTTS callers use.
+    """
+    seconds_per_word: float = 0.005
+    silence_seconds: float = 0.02
+    sample_rate: int = 24000
+
+    def __init__(self, text: str, lang: str = "en", *args, **kwargs) -> None:
+        self.text = text
+
+    def save(self, savefile: str) -> None:
+        n_words = max(1, len(self.text.split()))
+        word = max(1, int(self.sample_rate * self.seconds_per_word))
+        silence = np.zeros(int(self.sample_rate * self.silence_seconds))
+
+        syllable = 0.3 * np.sin(2 * np.pi * 440 * np.arange(word) / self.sample_rate) * np.hanning(word)
+        speech = np.concatenate([silence, np.tile(syllable, n_words), silence])
+
+        with wave.open(savefile, "wb") as clip:
+            clip.setnchannels(1)
+            clip.setsampwidth(2)
+            clip.setframerate(self.sample_rate)
+            clip.writeframes((speech * 32767).astype("<i2").tobytes())
+
+
+def use_null_audio_sink() -> None:
+    """
+    Sends pygame's audio to SDL's dummy driver, which plays at real time speed without a sound card.
+    Must be called before the pygame mixer is initialized.
+    """
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+
+def use_fake_tts() -> None:
+    """
+    Replaces gTTS with FakeTTS. Must be called before the onscreen character modules are imported.
+    """
+    import gtts
+    gtts.gTTS = FakeTTS
@@ -0,0 +1,41 @@
+"""
+Helpers for summarizing benchmark timings
+"""
+import math
+
+
+def percentile(sorted_samples: list[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of already sorted samples.
+    """
+    if not sorted_samples:
+        return float("nan")
+
+    rank = max(1, math.ceil(pct / 100 * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+
+def summarize(stage: str, samples: list[float], wall_time: float | None = None) -> dict:
+    """
+    Summarizes the durations (in seconds) recorded for a stage. Throughput is measured against the wall time if
+    one is given, otherwise against the total of all samples.
+    """
+    ordered = sorted(samples)
+    total = wall_time if wall_time is not None else sum(ordered)
+
+    return {
+        "stage": stage,
+        "n": len(ordered),
+        "throughput": len(ordered) / total if total > 0 else float("nan"),
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000
+    }
+
+
+def print_table(rows: list[dict]) -> None:
+    print(f"{'stage':<28} {'n':>6} {'ops/s':>10} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10}")
+
+    for row in rows:
+        print(f"{row['stage']:<28} {row['n']:>6} {row['throughput']:>10.1f} {row['p50_ms']:>10.3f} "
+              f"{row['p95_ms']:>10.3f} {row['p99_ms']:>10.3f}")
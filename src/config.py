@@ -0,0 +1,169 @@
+"""
+Settings for the bot and the OSC API, read from the environment (and a .env file if there is one) once per process
+"""
+import os
+import dotenv
+from dataclasses import dataclass
+from typing import Optional
+
+DEFAULT_COGS = ("src.jbot.cogs.ai_interactions", "src.jbot.cogs.test")
+
+_config: Optional["Config"] = None
+
+
+@dataclass(frozen=True)
+class Config:
+    # LLM API
+    llm_model: str
+    api_key: str
+    api_url: Optional[str]
+    system_message: Optional[str]
+    n_ctx: Optional[int]
+    verbose: bool
+
+    # Extra LLM backends, routed over when more than one is configured
+    api_urls: tuple[Optional[str], ...]
+    local_model_path: Optional[str]
+    llm_timeout: Optional[float]
+    llm_health_interval: float
+
+    # OBS websockets
+    obs_host: str
+    obs_port: int
+    obs_password: str
+
+    # Post-processing of synthesized speech
+    audio_processing: bool
+    audio_tempo: float
+    audio_target_dbfs: float
+    audio_silence_dbfs: float
+
+    # Lip-sync for characters with a talking source
+    lip_sync_rate: float
+    lip_sync_threshold_dbfs: float
+
+    # OSC API characters
+    characters_file: str
+    character_idle_seconds: float
+
+    # OSC API chat queue, kept in memory only if no database is set
+    queue_db: Optional[str]
+    queue_max_attempts: int
+    queue_retry_delay: float
+
+    # Discord bot
+    discord_token: Optional[str]
+    admin_msg_channel: Optional[int]
+    aichar_api_url: str
+    cogs: tuple[str, ...]
+
+    # Metrics and usage limits
+    metrics_enabled: bool
+    api_usage_file: Optional[str]
+    bot_usage_file: Optional[str]
+    rate_limit_burst: int
+    rate_limit_per_minute: float
+    token_budget_per_hour: Optional[int]
+    client_rate_limit_burst: int
+    client_rate_limit_per_minute: float
+    queue_max_pending: Optional[int]
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        """
+        Parses the settings from the environment variables, raising a ValueError naming the variable if one is
+        malformed.
+        """
+        cogs = os.getenv("JBOT_COGS")
+        api_url = os.getenv("AI_API_URL") or None
+        api_urls = os.getenv("AI_API_URLS")
+
+        return cls(
+            llm_model=os.getenv("AI_LLM_MODEL", ""),
+            api_key=os.getenv("AI_API_KEY", ""),
+            api_url=api_url,
+            system_message=os.getenv("AI_SYSTEM_MESSAGE"),
+            n_ctx=_get_int("AI_n_ctx"),
+            verbose=bool(os.getenv("AI_VERBOSE")),
+            api_urls=_split(api_urls) if api_urls is not None else (api_url,),
+            local_model_path=os.getenv("AI_LOCAL_MODEL_PATH") or None,
+            llm_timeout=_get_float("AI_LLM_TIMEOUT", None),
+            llm_health_interval=_get_float("AI_LLM_HEALTH_INTERVAL", 30.0),
+            obs_host=os.getenv("OBSWS_HOST", "localhost"),
+            obs_port=_get_int("OBSWS_PORT", 4455),
+            obs_password=os.getenv("OBSWS_PASSWORD", ""),
+            audio_processing=os.getenv("AI_AUDIO_PROCESSING", "1") != "0",
+            audio_tempo=_get_float("AI_AUDIO_TEMPO", 1.25),
+            audio_target_dbfs=_get_float("AI_AUDIO_TARGET_DBFS", -20.0),
+            audio_silence_dbfs=_get_float("AI_AUDIO_SILENCE_DBFS", -50.0),
+            lip_sync_rate=_get_float("AI_LIP_SYNC_RATE", 15.0),
+            lip_sync_threshold_dbfs=_get_float("AI_LIP_SYNC_THRESHOLD_DBFS", -35.0),
+            characters_file=os.getenv("AI_CHARACTERS_FILE", "characters.csv"),
+            character_idle_seconds=_get_float("AI_CHARACTER_IDLE_SECONDS", 600.0),
+            queue_db=os.getenv("AI_QUEUE_DB", "chat_queue.db") or None,
+            queue_max_attempts=_get_int("AI_QUEUE_MAX_ATTEMPTS", 3),
+            queue_retry_delay=_get_float("AI_QUEUE_RETRY_DELAY", 5.0),
+            discord_token=os.getenv("DISCORD_TOKEN"),
+            admin_msg_channel=_get_int("ADMIN_MSG_CHANNEL"),
+            aichar_api_url=os.getenv("AICHAR_API_URL", "http://localhost:8000/api"),
+            cogs=_split(cogs) if cogs is not None else DEFAULT_COGS,
+            metrics_enabled=os.getenv("AI_METRICS", "1") != "0",
+            api_usage_file=os.getenv("AI_USAGE_FILE", "api_usage.json") or None,
+            bot_usage_file=os.getenv("JBOT_USAGE_FILE", "bot_usage.json") or None,
+            rate_limit_burst=_get_int("AI_RATE_LIMIT_BURST", 3),
+            rate_limit_per_minute=_get_float("AI_RATE_LIMIT_PER_MINUTE", 6.0),
+            token_budget_per_hour=_get_int("AI_TOKEN_BUDGET_PER_HOUR"),
+            client_rate_limit_burst=_get_int("AI_CLIENT_RATE_LIMIT_BURST", 20),
+            client_rate_limit_per_minute=_get_float("AI_CLIENT_RATE_LIMIT_PER_MINUTE", 60.0),
+            queue_max_pending=_get_int("AI_QUEUE_MAX_PENDING", 200) or None
+        )
+
+
+def get_config() -> Config:
+    """
+    Returns the settings, loading the .env file and parsing the environment on first use.
+    """
+    global _config
+
+    if _config is None:
+        _config = load_config()
+
+    return _config
+
+
+def load_config() -> Config:
+    """
+    Loads the .env file and parses the environment again, replacing the settings returned by get_config.
+    """
+    global _config
+
+    dotenv.load_dotenv(dotenv.find_dotenv())
+    _config = Config.from_env()
+    return _config
+
+
+def _get_int(name: str, default: Optional[int] = None) -> Optional[int]:
+    value = os.getenv(name)
+    if not value:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a whole number, not {value!r}") from None
+
+
+def _get_float(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.getenv(name)
+    if not value:
+        return default
+
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, not {value!r}") from None
+
+
+def _split(value: str) -> tuple[str, ...]:
+    # Comma separated lists, ignoring whitespace and empty entries
+    return tuple(item.strip() for item in value.split(",") if item.strip())
@@ -0,0 +1,89 @@
+"""
+Async client for the onscreen character API used by JBot
+"""
+import json
+import aiohttp
+from typing import Optional, AsyncIterator
+
+
+class AICharAPIClient:
+    """
+    Shares one pooled HTTP session for every request to the onscreen character API and keeps a cached copy of the
+    available characters so building a modal never needs a network round-trip.
+    """
+
+    def __init__(self, api_url: str, timeout: float = 10.0, max_connections: int = 20) -> None:
+        """
+        :param api_url: Base url of the API, for example http://localhost:8000/api
+        :param timeout: How long to wait in seconds for a regular request to finish.
+        :param max_connections: Size of the connection pool.
+        """
+        # Remove trailing backslash
+        self._api_url = api_url[:-1] if api_url.endswith("/") else api_url
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._max_connections = max_connections
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._characters: list[str] = []
+
+    @property
+    def characters(self) -> list[str]:
+        """
+        The characters from the last successful refresh. Empty if the API has not been reached yet.
+        """
+        return self._characters
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session has to be created while the event loop is running, so it is done on first use
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._max_connections)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+
+        return self._session
+
+    async def refresh_characters(self) -> list[str]:
+        """
+        Fetches the available characters from the API and updates the cache.
+        """
+        async with self._get_session().get(f"{self._api_url}/characters") as response:
+            response.raise_for_status()
+            self._characters = await response.json()
+
+        return self._characters
+
+    async def submit_prompt(self, char_name: str, prompt: str, submitter: Optional[str] = None) -> tuple[int, dict]:
+        """
+        Queues a prompt for a character on behalf of submitter, who the API rate limits and charges usage to.
+        Returns the status code and the decoded JSON body of the response.
+        """
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        params = {"submitter": submitter} if submitter is not None else None
+
+        async with self._get_session().post(f"{self._api_url}/{char_name}/chat", data=prompt.encode("utf-8"),
+                                            headers=headers, params=params) as response:
+            return response.status, await response.json()
+
+    async def job_events(self, job_id: str) -> AsyncIterator[dict]:
+        """
+        Follows the server-sent event stream of a queued job, yielding each state it goes through until it finishes.
+        """
+        # The stream stays open for as long as the job waits in the queue, so only the connection is time limited
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self._timeout.total)
+
+        async with self._get_session().get(f"{self._api_url}/jobs/{job_id}/events", timeout=timeout) as response:
+            response.raise_for_status()
+            data_lines = []
+
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").rstrip("\r\n")
+
+                if line.startswith("data:"):
+                    data_lines.append(line[5:].lstrip())
+                elif line == "" and data_lines:
+                    # A blank line ends the event
+                    yield json.loads("\n".join(data_lines))
+                    data_lines = []
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -1,7 +1,6 @@
-import os
-import dotenv
 from typing import Optional
 from discord.ext import commands
+from src.config import get_config
 
 
 class JAIBot(commands.Bot):
@@ -10,8 +9,7 @@ class JAIBot(commands.Bot):
     def __init__(self):
         super().__init__()
 
-        dotenv.load_dotenv(dotenv.find_dotenv())
-        self._admin_channel = int(os.getenv("ADMIN_MSG_CHANNEL"))
+        self._admin_channel = get_config().admin_msg_channel
 
     async def on_ready(self):
         print(f"Logged in as {self.user.name} ID: {self.user.id}")
@@ -1,149 +1,243 @@
-import os
-import dotenv
-import openai
+import asyncio
+import aiohttp
 import discord
-import requests
-from typing import Optional
-from discord.ext import commands
-from ...llm import RemoteLLMManager
-from ..helper_functions import *
+from typing import Optional, Callable, Awaitable
+from discord.ext import commands, tasks
+from ...config import get_config
+from ...llm import BaseLLM, NoBackendAvailable, create_llm_manager, monitor_backends
+from ...telemetry import metrics
+from ...usage import UsageLedger, UsageLimits
+from ..aichar_client import AICharAPIClient
+from ..response_renderer import StreamingResponseRenderer
+
+
+# How often the cached list of onscreen characters is refreshed
+CHARACTER_REFRESH_SECONDS = 60
 
 
 class AIInteractions(commands.Cog):
     def __init__(self, bot):
         print("[AIInteractions Cog] Initializing!")
         self.bot = bot
-        dotenv.load_dotenv(dotenv.find_dotenv())
-
-        # Variables to connect to LLM API
-        llm_model: str = str(os.getenv("AI_LLM_MODEL"))
-        api_key: str = str(os.getenv("AI_API_KEY"))
-        api_url: str = str(os.getenv("AI_API_URL"))
-        system_message: Optional[str] = os.getenv("AI_SYSTEM_MESSAGE")
-        verbose: bool = bool(os.getenv("AI_VERBOSE"))
-        n_ctx: int = int(os.getenv("AI_n_ctx"))
-        self._aichar_api_url = str(os.getenv("AICHAR_API_URL"))
+        self._config = get_config()
 
-        # Remove trailing backslash
-        if self._aichar_api_url[-1] == "/":
-            self._aichar_api_url = self._aichar_api_url[:-1]
+        # One pooled client shared by every modal talking to the onscreen character API
+        self._aichar_api = AICharAPIClient(self._config.aichar_api_url)
 
         # TODO: Make each user have their own LLMManager
-        self._llm: RemoteLLMManager = RemoteLLMManager(llm_model, api_key, api_url,
-                                                       system_message=system_message, verbose=verbose, n_ctx=n_ctx)
+        # Created on first use (or by the warm-up once the bot is connected) as it makes a request to the LLM API
+        self._llm: Optional[BaseLLM] = None
+        self._llm_init_lock = asyncio.Lock()
+        self._warm_up_task: Optional[asyncio.Task] = None
+        self._health_task: Optional[asyncio.Task] = None
+
+        # The LLM is shared, so only one response may be generated at a time to keep its history in order
+        self._llm_lock = asyncio.Lock()
+
+        # Token usage of every Discord user and the limits they are held to
+        self._usage = UsageLedger()
+        self._limits = UsageLimits.from_config(self._config)
+
+        if self._config.bot_usage_file is not None:
+            try:
+                self._usage.load(self._config.bot_usage_file, missing_ok=True)
+            except Exception as e:
+                # The file is overwritten when the bot stops, so it does not have to be fixed by hand
+                print(f"[AIInteractions Cog] Could not load the usage totals, starting from zero: {e!r}")
+
+    async def get_llm(self) -> BaseLLM:
+        """
+        Returns the shared LLM manager, creating it off the event loop the first time.
+        """
+        async with self._llm_init_lock:
+            if self._llm is None:
+                self._llm = await asyncio.to_thread(create_llm_manager, self._config)
+
+        return self._llm
+
+    async def _warm_up(self):
+        try:
+            await self.get_llm()
+        except Exception as e:
+            # The next prompt tries again and reports the error to the user
+            print(f"[AIInteractions Cog] Could not connect to the LLM API: {e}")
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Background tasks need the running event loop so they are started once the bot is connected
+        if not self.refresh_characters.is_running():
+            self.refresh_characters.start()
+
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self._warm_up())
+
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(monitor_backends(self._config.llm_health_interval))
+
+    def cog_unload(self):
+        self.refresh_characters.cancel()
+
+        for task in (self._warm_up_task, self._health_task):
+            if task is not None:
+                task.cancel()
+
+        # Also runs when the bot is closed
+        if self._config.bot_usage_file is not None:
+            try:
+                self._usage.save(self._config.bot_usage_file)
+            except OSError as e:
+                print(f"[AIInteractions Cog] Could not save the usage totals: {e!r}")
+
+        self.bot.loop.create_task(self._aichar_api.close())
+
+    @tasks.loop(seconds=CHARACTER_REFRESH_SECONDS)
+    async def refresh_characters(self):
+        try:
+            await self._aichar_api.refresh_characters()
+        except (aiohttp.ClientError, TimeoutError) as e:
+            print(f"[AIInteractions Cog] Could not refresh the AICharacter list: {e}")
 
     ai_cmdgrp = discord.SlashCommandGroup("ai", "AI Interactions")
 
     @ai_cmdgrp.command(name="prompt", description="Talk to an LLM with your own prompt.")
     async def basic_prompt_modal(self, ctx: discord.ApplicationContext):
-        modal = BasicPrompt(title="AI Prompt Modal", llm=self._llm)
+        modal = BasicPrompt(title="AI Prompt Modal", get_llm=self.get_llm, llm_lock=self._llm_lock,
+                            usage=self._usage, limits=self._limits)
         await ctx.send_modal(modal)
 
+    @ai_cmdgrp.command(name="stats", description="Show how long AI requests from the bot have been taking.")
+    async def stats(self, ctx: discord.ApplicationContext):
+        embed = discord.Embed(title="AI Stats", colour=discord.Colour.blurple())
+
+        # Embeds can only hold 25 fields
+        for name, summary in list(metrics.REGISTRY.snapshot().items())[:25]:
+            if "count" in summary:
+                value = (f"count: {summary['count']}, p50: {summary['p50'] * 1000:.0f} ms, "
+                         f"p95: {summary['p95'] * 1000:.0f} ms, p99: {summary['p99'] * 1000:.0f} ms")
+            else:
+                value = f"{summary['value']:g}"
+
+            embed.add_field(name=name, value=value, inline=False)
+
+        if len(embed.fields) == 0:
+            embed.description = "Nothing has been recorded yet." if metrics.REGISTRY.enabled else "Metrics are disabled."
+
+        await ctx.respond(embed=embed)
+
+    @ai_cmdgrp.command(name="usage", description="Show how many LLM tokens you have used.")
+    async def usage(self, ctx: discord.ApplicationContext):
+        totals = self._usage.get("user", str(ctx.author.id))
+        await ctx.respond(f"You have sent {totals.requests} prompts using {totals.total_tokens} tokens "
+                          f"({totals.prompt_tokens} prompt, {totals.completion_tokens} completion).", ephemeral=True)
+
     aichars_cmdgrp = discord.SlashCommandGroup("aichars", "AI Character Interactions")
 
     @aichars_cmdgrp.command(name="prompt", description="Talk to a live AI Character with your own prompt.")
     async def aichars_prompt_modal(self, ctx: discord.ApplicationContext):
-        modal = CharPrompt(title="AICharacter Prompt Modal", api=self._aichar_api_url)
+        modal = CharPrompt(title="AICharacter Prompt Modal", api=self._aichar_api)
         await ctx.send_modal(modal)
 
 
 
 class BasicPrompt(discord.ui.Modal):
-    def __init__(self, llm: RemoteLLMManager, *args, **kwargs) -> None:
+    def __init__(self, get_llm: Callable[[], Awaitable[BaseLLM]], llm_lock: asyncio.Lock,
+                 usage: UsageLedger, limits: UsageLimits, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self._llm: RemoteLLMManager = llm
+        self._get_llm: Callable[[], Awaitable[BaseLLM]] = get_llm
+        self._llm_lock: asyncio.Lock = llm_lock
+        self._usage: UsageLedger = usage
+        self._limits: UsageLimits = limits
         self.add_item(discord.ui.InputText(label="Your prompt:", style=discord.InputTextStyle.long, max_length=1024))
 
     async def callback(self, interaction: discord.Interaction) -> None:
+        # Already loaded by the LLM manager, imported here so loading the cog does not pay for it
+        import openai
+
+        user_id = str(interaction.user.id)
+
+        # Turn heavy users away before any work is done
+        retry_after = self._limits.check(user_id)
+        if retry_after > 0:
+            await interaction.respond(f"⏳ You are sending prompts too quickly. Try again in {retry_after:.0f} seconds.",
+                                      ephemeral=True)
+            return
+
         await interaction.response.defer()
 
+        # Show the response as it is generated instead of waiting for all of it. Rendering runs on its own, so
+        # Discord's edit limits never hold up the LLM lock and the prompts of other users waiting on it.
+        renderer = StreamingResponseRenderer(interaction, self.children[0].value)
+        renderer.start()
+
         try:
-            ai_response = self._llm.ask(self.children[0].value)
-        except openai.APIConnectionError:
+            llm = await self._get_llm()
+
+            async with self._llm_lock:
+                stream = llm.ask_stream_async(self.children[0].value)
+                async for delta in stream:
+                    renderer.feed(delta)
+
+            self._usage.record(stream.usage, user=user_id, model=llm.model_name)
+            self._limits.charge_tokens(user_id, stream.usage)
+
+            await renderer.finish()
+        except (openai.APIConnectionError, NoBackendAvailable):
             await interaction.respond(content="❌ ERROR: AI API is down.")
             return
         except Exception as e:
             await interaction.respond(content="❌ ERROR: An unknown error occurred.")
             print(f"[ERROR] An unknown error has occurred! {e}")
             return
-
-        # Get our embed strings
-        embed_strs = paragraph_split(ai_response[0])
-
-        # Add our chunks until we hit 6k limit
-        embed_title: str = "AI Response"
-        prompt_str: str = "Prompt:"
-        answer_str: str = "Answer:"
-
-        # Add prompt text and the answer title first
-        embeds = [discord.Embed(title=embed_title, colour=discord.Colour.blurple())]
-        embeds[0].add_field(name=prompt_str, value=self.children[0].value, inline=False)
-
-        max_embed_length: int = 6000
-        max_fields: int = 25
-        total_fields: int = 1
-        total_characters: int = len(self.children[0].value) + len(embed_title) + len(prompt_str) + len(answer_str)
-        cur_idx: int = 0
-
-        # Process all embed strings
-        while len(embed_strs) > 0:
-            # Keep adding fields until we hit the max length of 6k characters or 25 fields
-            if total_characters + len(embed_strs[0]) < max_embed_length and total_fields < max_fields:
-                total_characters += len(embed_strs[0])
-                total_fields += 1
-
-                # First chunk of AI Response will always have "Answer:" as the title
-                if cur_idx == 0 and total_fields == 2:
-                    name: str = answer_str
-                else:
-                    name: str = ""
-
-                embeds[cur_idx].add_field(name=name, value=embed_strs.pop(0), inline=False)
-
-            else:
-                # Add a new embed and go to the next
-                embeds.append(discord.Embed(title="", colour=discord.Colour.blurple()))
-                cur_idx += 1
-                total_fields = 0
-                total_characters = 0
-
-        # Send first embed
-        await interaction.respond(embed=embeds[0])
-
-        # Send the rest if we have any
-        if len(embeds) > 1:
-            # Need to send the rest as individual messages
-            for i in range(1, len(embeds)):
-                await interaction.respond(embed=embeds[i])
+        finally:
+            renderer.cancel()
 
 
 class CharPrompt(discord.ui.Modal):
-    def __init__(self, api, *args, **kwargs) -> None:
+    STATUS_MESSAGES = {
+        "generating": "💭 {char_name} is thinking about your prompt...",
+        "synthesizing": "🗣️ {char_name} is getting ready to speak...",
+        "playing": "🔊 {char_name} is answering your prompt:\n>>> {text}",
+        "done": "✅ {char_name} answered your prompt:\n>>> {text}",
+        "failed": "❌ {char_name} could not answer your prompt."
+    }
+
+    def __init__(self, api: AICharAPIClient, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self._api = api
+        self._api: AICharAPIClient = api
 
-        # Get available characters to display in modal
-        response = requests.get("http://localhost:8000/api/characters")
-        chars = response.json()
-        char_names = ', '.join(chars)
+        # Use the cached characters so opening the modal does not wait on the API
+        char_names = ', '.join(self._api.characters)
 
         self.add_item(discord.ui.InputText(label=f"Character Name: ({char_names})", style=discord.InputTextStyle.short))
         self.add_item(discord.ui.InputText(label="Your prompt:", style=discord.InputTextStyle.long, max_length=1024))
 
     async def callback(self, interaction: discord.Interaction) -> None:
         char_name = self.children[0].value.capitalize()
-        prompt = self.children[1].value.encode("utf-8")
-        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        prompt = self.children[1].value
 
-        response = requests.post(f"{self._api}/{char_name}/chat", data=prompt, headers=headers)
+        try:
+            status_code, response = await self._api.submit_prompt(char_name, prompt, str(interaction.user.id))
+        except (aiohttp.ClientError, TimeoutError):
+            await interaction.respond(content="❌ ERROR: AICharacter API is down.")
+            return
 
-        if response.status_code != 202:
-            await interaction.respond(f"❌ {response.json()['detail']}")
+        if status_code != 202:
+            await interaction.respond(f"❌ {response['detail']}")
             return
 
-        response = response.json()
         await interaction.respond(f"✅ Your prompt to {char_name} was queued at position {response['Queue Position']}")
 
+        # Keep the message up to date as the prompt moves through the queue
+        try:
+            async for event in self._api.job_events(response["Job ID"]):
+                status_message = self.STATUS_MESSAGES.get(event["status"])
+
+                if status_message is not None:
+                    content = status_message.format(char_name=char_name, text=event["text"] or "")
+                    await interaction.edit_original_response(content=content[:2000])
+        except (aiohttp.ClientError, TimeoutError, discord.HTTPException) as e:
+            print(f"[AIInteractions Cog] Stopped following job {response['Job ID']}: {e}")
+
 
 def setup(bot):  # this is called by Pycord to set up the cog
     bot.add_cog(AIInteractions(bot))  # add the cog to the bot
@@ -1,70 +1,98 @@
 """
 Helper functions used in JBot
 """
+import re
+
+# Matches up to the last sentence ending (. ? !) in a piece of text. The greedy match runs straight to the end of
+# the piece then backtracks, so only the characters after the last sentence ending are looked at.
+_LAST_SENTENCE_END = re.compile(r".*[.?!]", re.DOTALL)
 
 
 def paragraph_split(text: str, max_per_chunk: int = 1024) -> list[str]:
     """
     Splits a text into (maximum) 1024 character chunks. Tries to split cleanly along sentences whenever possible.
+    Runs in linear time: every paragraph is visited once and each chunk is joined once.
     """
-    # Split into paragraphs (\n)
-    paragraphs = text.split("\n")
     chunks = []
+    cur_chunk: list[str] = []
+    cur_length = 0
 
-    # Process all paragraphs
-    while len(paragraphs) > 0:
-        cur_chunk = ""
-
+    # Split into paragraphs (\n)
+    for paragraph in text.split("\n"):
         # Keep adding until we cannot cleanly add anymore paragraphs without reaching the limit
-        while len(paragraphs[0]) + len(cur_chunk) + 1 <= max_per_chunk:
-            cur_chunk += paragraphs.pop(0) + "\n"
+        if cur_length + len(paragraph) + 1 <= max_per_chunk:
+            cur_chunk.append(paragraph)
+            cur_length += len(paragraph) + 1
+            continue
+
+        # We have our chunk, add it into the list
+        if cur_chunk:
+            chunks.append("\n".join(cur_chunk) + "\n")
+            cur_chunk = []
+            cur_length = 0
 
-            if len(paragraphs) == 0:
-                break
+            if len(paragraph) + 1 <= max_per_chunk:
+                cur_chunk.append(paragraph)
+                cur_length = len(paragraph) + 1
+                continue
 
-        # Case where we have one paragraph 1024 characters or longer.
-        if cur_chunk == "" and len(paragraphs) > 0:
-            punctuations = [".", "?", "!"]
+        # Case where we have one paragraph 1024 characters or longer. Subtract 1 to account for the "\n" character.
+        pieces = sentence_split(paragraph, max_per_chunk - 1)
+        chunks.extend(piece + "\n" for piece in pieces[:-1])
 
-            # Split based on punctuation if possible, otherwise it splits on the 1023 characters mark.
-            # Subtract 1 to account for the "\n" character
-            cur_chunk, paragraphs[0] = split_substring_before(paragraphs[0], punctuations, max_per_chunk - 1)
-            cur_chunk += "\n"
+        # The remainder can still share a chunk with the paragraphs after it
+        cur_chunk.append(pieces[-1])
+        cur_length = len(pieces[-1]) + 1
 
-        # We have our chunk, add it into the list
-        chunks.append(cur_chunk)
+    if cur_chunk:
+        chunks.append("\n".join(cur_chunk) + "\n")
 
     return chunks
 
 
-def split_substring_before(text: str, substrings: list[str], before: int) -> tuple[str, str]:
+def sentence_split(text: str, max_length: int) -> list[str]:
     """
-    Splits a given text on any of the substrings given. The substrings are searched for in the index values before
-    the one provided. If no substrings are found, we split the text in two pieces. All text before the "before index"
-    and all text after it.
+    Splits a text into pieces of at most max_length characters. Each piece ends on the last sentence ending (. ? !)
+    that fits, otherwise the text is cut at max_length. Each piece is found with a single scan back from its end,
+    without copying the text.
     """
-    search_segment = text[:before]
+    pieces = []
+    start = 0
+
+    while len(text) - start > max_length:
+        limit = start + max_length
+        match = _LAST_SENTENCE_END.match(text, start, limit)
 
-    # Search for the last piece of any substring
-    last_substring_idx = find_substring_last(search_segment, substrings)
+        # Split after the sentence ending if we found one, otherwise split on the max length
+        cut = match.end() if match is not None else limit
 
-    if last_substring_idx == -1:
-        # Didn't find any substrings
-        return text[:before], text[before:]
+        pieces.append(text[start:cut])
+        start = cut
 
-    # Found a substring, split on it
-    return text[:last_substring_idx], text[last_substring_idx:]
+    pieces.append(text[start:])
+    return pieces
 
 
-def find_substring_last(text: str, substrings: list[str]) -> int:
+def pack_embeds(chunks: list[str], first_length: int = 0, first_fields: int = 0,
+                max_embed_length: int = 6000, max_fields: int = 25) -> list[list[str]]:
     """
-    Finds the last occurrence of ANY substring in the provided list. Returns -1 if no substrings are found.
+    Groups chunks into embeds, one chunk per field, so that no embed reaches Discord's character or field limits.
+    first_length and first_fields reserve room in the first embed for content added to it separately.
+    Returns the chunks that belong to each embed. The first group may be empty if nothing else fits in it.
     """
-    max_idx = -1
-    for substring in substrings:
-        cur_idx = text.rfind(substring)
-
-        if cur_idx > max_idx:
-            max_idx = cur_idx
-
-    return max_idx
+    embeds: list[list[str]] = [[]]
+    total_characters = first_length
+    total_fields = first_fields
+
+    for chunk in chunks:
+        # Add a new embed once this chunk would go over the max length of 6k characters or 25 fields
+        if total_characters + len(chunk) >= max_embed_length or total_fields >= max_fields:
+            embeds.append([])
+            total_characters = 0
+            total_fields = 0
+
+        embeds[-1].append(chunk)
+        total_characters += len(chunk)
+        total_fields += 1
+
+    return embeds
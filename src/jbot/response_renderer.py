@@ -0,0 +1,155 @@
+"""
+Renders AI responses as Discord embeds, either all at once or incrementally while the response is being generated
+"""
+import asyncio
+import discord
+from typing import Optional
+from .helper_functions import paragraph_split, pack_embeds
+
+# Appended to the response while it is still being generated
+STREAMING_CURSOR = " ▌"
+
+
+def build_response_embeds(prompt: str, answer: str) -> list[discord.Embed]:
+    """
+    Builds the embeds showing a prompt and the AI's answer, split up so each embed stays within Discord's limits.
+    """
+    embed_title: str = "AI Response"
+    prompt_str: str = "Prompt:"
+    answer_str: str = "Answer:"
+
+    # The first embed also holds the title and prompt, so reserve room for them
+    first_length = len(prompt) + len(embed_title) + len(prompt_str) + len(answer_str)
+    embed_groups = pack_embeds(paragraph_split(answer), first_length=first_length, first_fields=1)
+
+    embeds = []
+    for embed_idx, chunks in enumerate(embed_groups):
+        if embed_idx == 0:
+            # Add prompt text and the answer title first
+            embed = discord.Embed(title=embed_title, colour=discord.Colour.blurple())
+            embed.add_field(name=prompt_str, value=prompt, inline=False)
+        else:
+            embed = discord.Embed(title="", colour=discord.Colour.blurple())
+
+        for chunk_idx, chunk in enumerate(chunks):
+            # First chunk of AI Response will always have "Answer:" as the title
+            name: str = answer_str if embed_idx == 0 and chunk_idx == 0 else ""
+            embed.add_field(name=name, value=chunk, inline=False)
+
+        embeds.append(embed)
+
+    return embeds
+
+
+class StreamingResponseRenderer:
+    """
+    Shows a response in a deferred interaction while it is being generated. The original response is edited in
+    place, and a new message is sent whenever the response outgrows the embeds already sent. Rendering happens in a
+    task of its own, so whoever feeds the response never waits on Discord, and edits are rate limited so we stay
+    within Discord's edit limits.
+    """
+
+    def __init__(self, interaction: discord.Interaction, prompt: str, edit_interval: float = 1.0) -> None:
+        """
+        :param interaction: A deferred interaction to respond to.
+        :param prompt: The prompt the response is for.
+        :param edit_interval: Minimum number of seconds between two renders while streaming.
+        """
+        self._interaction = interaction
+        self._prompt = prompt
+        self._edit_interval = edit_interval
+
+        self._parts: list[str] = []
+        self._changed = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        # What was last sent for every message, so unchanged messages are not edited again
+        self._sent_embeds: list[dict] = []
+        self._followups: list[Optional[discord.WebhookMessage]] = []
+
+    def start(self) -> None:
+        """
+        Starts rendering the response as it is fed.
+        """
+        self._task = asyncio.create_task(self._render_loop())
+
+    def feed(self, delta: str) -> None:
+        """
+        Adds a newly generated piece of the response, to be rendered once enough time has passed since the last
+        render.
+        """
+        self._parts.append(delta)
+        self._changed.set()
+
+    async def finish(self) -> None:
+        """
+        Waits for a render in progress, then renders the complete response without the streaming cursor.
+        Raises the error of a render that failed while streaming.
+        """
+        self._closed.set()
+        self._changed.set()
+
+        if self._task is not None:
+            await self._task
+
+        await self._render("")
+
+    def cancel(self) -> None:
+        """
+        Stops rendering without showing the rest of the response, for when generating it failed.
+        """
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _render_loop(self) -> None:
+        while True:
+            await self._changed.wait()
+            if self._closed.is_set():
+                return
+
+            self._changed.clear()
+            await self._render(STREAMING_CURSOR)
+
+            # Waits out the edit interval, unless the response is finished in the meantime
+            try:
+                await asyncio.wait_for(self._closed.wait(), self._edit_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _render(self, suffix: str) -> None:
+        text = "".join(self._parts)
+        if not text.strip():
+            return
+
+        embeds = build_response_embeds(self._prompt, text + suffix)
+
+        for idx, embed in enumerate(embeds):
+            embed_dict = embed.to_dict()
+
+            if idx < len(self._sent_embeds):
+                if self._sent_embeds[idx] != embed_dict:
+                    await self._edit(idx, embed)
+                    self._sent_embeds[idx] = embed_dict
+            else:
+                # The response got too long for the messages we have, roll over to a new one
+                await self._send(embed)
+                self._sent_embeds.append(embed_dict)
+
+        # Dropping the cursor can let the response fit in one less message
+        while len(self._sent_embeds) > max(len(embeds), 1):
+            await self._followups.pop().delete()
+            self._sent_embeds.pop()
+
+    async def _send(self, embed: discord.Embed) -> None:
+        if len(self._sent_embeds) == 0:
+            await self._interaction.edit_original_response(embed=embed)
+            self._followups.append(None)
+        else:
+            self._followups.append(await self._interaction.followup.send(embed=embed, wait=True))
+
+    async def _edit(self, idx: int, embed: discord.Embed) -> None:
+        if idx == 0:
+            await self._interaction.edit_original_response(embed=embed)
+        else:
+            await self._followups[idx].edit(embed=embed)
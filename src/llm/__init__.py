@@ -2,3 +2,5 @@ from .llmexceptions import *
 from .base_llm import *
 from .local_llm import *
 from .remote_llm import *
+from .router_llm import *
+from .factory import *
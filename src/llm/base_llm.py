@@ -1,14 +1,48 @@
 import json
 import copy
-from typing import Optional
+import time
+import asyncio
+from typing import Optional, AsyncIterator
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from src.telemetry import metrics
 from .llmexceptions import *
 
 
+class ResponseStream:
+    """
+    Async iterator over the pieces of an LLM response as they are generated. Once it has been fully iterated,
+    response and usage hold the complete response and its token usage information.
+    """
+
+    def __init__(self) -> None:
+        self.usage: dict[str, int] = {}
+        self._parts: list[str] = []
+        self._deltas: Optional[AsyncIterator[str]] = None
+
+    @property
+    def response(self) -> str:
+        """
+        Everything received so far.
+        """
+        return "".join(self._parts)
+
+    def __aiter__(self) -> "ResponseStream":
+        return self
+
+    async def __anext__(self) -> str:
+        delta = await self._deltas.__anext__()
+        self._parts.append(delta)
+
+        return delta
+
+
 class BaseLLM(ABC):
     """
     Base Abstract Class for interacting with an LLM but is missing an actual LLM implementation.
     """
+    # Identifies the kind of backend in metrics
+    backend_name: str = "base"
 
     def __init__(self, system_message: Optional[str] = None, n_ctx: int = 512,
                  temperature: float = 1.0, token_trim: float = 0.9,
@@ -45,6 +79,13 @@ class BaseLLM(ABC):
                 self._system_msg_tokens = self.get_token_msg(self._messages[0]["content"], "system")
                 self._log(f"Imported system message with {self._system_msg_tokens} tokens.")
 
+    @property
+    def model_name(self) -> str:
+        """
+        Name of the model answering our questions. Used to attribute usage.
+        """
+        return self.backend_name
+
     def add_message(self, role: str, content: str) -> None:
         """
         Adds a new message to the conversation history of the LLM.
@@ -73,6 +114,35 @@ class BaseLLM(ABC):
             self.clear_message_history()
             return
 
+        messages = self._validate_message_history(messages)
+
+        sysmsg_tokens = None
+        if messages[0]["role"] == "system":
+            sysmsg_tokens = self.get_token_msg(messages[0]["content"], "system")
+
+        self._apply_message_history(messages, sysmsg_tokens)
+
+    async def set_message_history_async(self, messages: list[dict[str, str]] | None = None) -> None:
+        """
+        Async version of set_message_history. Token counting for a new system message does not block the event loop.
+        """
+        if messages is None:
+            self.clear_message_history()
+            return
+
+        messages = self._validate_message_history(messages)
+
+        sysmsg_tokens = None
+        if messages[0]["role"] == "system":
+            sysmsg_tokens = await self.get_token_msg_async(messages[0]["content"], "system")
+
+        self._apply_message_history(messages, sysmsg_tokens)
+
+    @staticmethod
+    def _validate_message_history(messages: list[dict[str, str]]) -> list[dict[str, str]]:
+        """
+        Validates a message history given to us, returning a copy of it that is safe to store.
+        """
         messages = copy.deepcopy(messages)
         valid_roles = ("system", "user", "assistant")
 
@@ -82,9 +152,15 @@ class BaseLLM(ABC):
             assert isinstance(message["content"], str)
             assert message["role"] in valid_roles
 
+        return messages
+
+    def _apply_message_history(self, messages: list[dict[str, str]], sysmsg_tokens: Optional[int]) -> None:
+        """
+        Stores an already validated message history. sysmsg_tokens must be given if the history has a system message.
+        """
         # Check if a system message is included in the given message history and deal with it accordingly
         if messages[0]["role"] == "system":
-            self._system_msg_tokens = self.get_token_msg(messages[0]["content"], "system")
+            self._system_msg_tokens = sysmsg_tokens
             self._messages = messages
             return
 
@@ -109,6 +185,13 @@ class BaseLLM(ABC):
             # Clear all but the first message if we do have a system message
             self._messages = [self._messages[0]]
 
+    def restore_message_history(self, messages: list[dict[str, str]]) -> None:
+        """
+        Puts back a history taken with get_message_history, for undoing a failed ask. It is not validated or counted
+        again, so the system message must not have changed since.
+        """
+        self._messages = copy.deepcopy(messages)
+
     def set_system_message(self, system_message: str | None = None) -> int:
         """
         Sets a new system message, returning the number of tokens present
@@ -119,7 +202,27 @@ class BaseLLM(ABC):
             return 0
 
         new_sysmsg_tokens = self.get_token_msg(system_message, "system")
+        self._apply_system_message(system_message, new_sysmsg_tokens)
 
+        return new_sysmsg_tokens
+
+    async def set_system_message_async(self, system_message: str | None = None) -> int:
+        """
+        Async version of set_system_message. Returns the number of tokens present in the new system message.
+        """
+        if system_message is None:
+            self.clear_system_message()
+            return 0
+
+        new_sysmsg_tokens = await self.get_token_msg_async(system_message, "system")
+        self._apply_system_message(system_message, new_sysmsg_tokens)
+
+        return new_sysmsg_tokens
+
+    def _apply_system_message(self, system_message: str, sysmsg_tokens: int) -> None:
+        """
+        Places a system message at the start of the history, replacing the old one if there is one.
+        """
         if len(self._messages) == 0:
             self.add_message("system", system_message)
         elif self._messages[0]["role"] == "system":
@@ -127,9 +230,7 @@ class BaseLLM(ABC):
         else:
             self._messages.insert(0, {"role": "system", "content": system_message})
 
-        self._system_msg_tokens = new_sysmsg_tokens
-
-        return new_sysmsg_tokens
+        self._system_msg_tokens = sysmsg_tokens
 
     def clear_system_message(self) -> bool:
         """
@@ -150,47 +251,202 @@ class BaseLLM(ABC):
         to process first. Then, we trim messages if needed to stay within the acceptable context fill %.
         """
         # Ensure message itself does not exceed max tokens
-        msg_tokens = self.get_token_msg(msg)
-        self._log(f"Got a prompt with {msg_tokens} tokens.")
-
-        if msg_tokens + self._system_msg_tokens > self._token_trim * self._n_ctx:
-            raise MaxCtxWindow(f"Message {msg} has {msg_tokens} exceeds maximum context window.")
+        with metrics.TOKEN_COUNT_SECONDS.time():
+            msg_tokens = self.get_token_msg(msg)
+        self._check_prompt_tokens(msg, msg_tokens)
 
         # Add the message to the history
         self.add_message("user", msg)
 
         # Check our token usage, trim if percentage used is too high
-        cur_token = self.get_token_count()
-        fill_amount = self.get_token_count() / self._n_ctx
-
-        self._log(f"Current token count in history is {cur_token}. "
-                  f"Context Fill % is {fill_amount * 100:.2f}%.")
+        with metrics.TOKEN_COUNT_SECONDS.time():
+            cur_token = self.get_token_count()
+        fill_amount = cur_token / self._n_ctx
+        self._log_fill(cur_token, fill_amount)
 
         # Keep removing old messages until context fill % is low enough
         while fill_amount > self._token_trim:
-            if self._messages[0]["role"] != "system":
-                self._messages.pop(0)
-            else:
-                self._messages.pop(1)
+            self._pop_oldest_message()
 
-            cur_token = self.get_token_count()
-            fill_amount = self.get_token_count() / self._n_ctx
+            with metrics.TOKEN_COUNT_SECONDS.time():
+                cur_token = self.get_token_count()
+            fill_amount = cur_token / self._n_ctx
+            self._log_fill(cur_token, fill_amount, popped=True)
 
-            self._log(f"Popped a message! Token count is now {cur_token}. "
-                      f"Context Fill % is {fill_amount * 100:.2f}%.")
+        return True
+
+    async def _prep_ask_async(self, msg: str) -> bool:
+        """
+        Async version of _prep_ask. Token counting is awaited so the event loop is free while the backend works.
+        """
+        with metrics.TOKEN_COUNT_SECONDS.time():
+            msg_tokens = await self.get_token_msg_async(msg)
+        self._check_prompt_tokens(msg, msg_tokens)
+
+        self.add_message("user", msg)
+
+        with metrics.TOKEN_COUNT_SECONDS.time():
+            cur_token = await self.get_token_count_async()
+        fill_amount = cur_token / self._n_ctx
+        self._log_fill(cur_token, fill_amount)
+
+        while fill_amount > self._token_trim:
+            self._pop_oldest_message()
+
+            with metrics.TOKEN_COUNT_SECONDS.time():
+                cur_token = await self.get_token_count_async()
+            fill_amount = cur_token / self._n_ctx
+            self._log_fill(cur_token, fill_amount, popped=True)
 
         return True
 
-    @abstractmethod
+    def _check_prompt_tokens(self, msg: str, msg_tokens: int) -> None:
+        """
+        Raises MaxCtxWindow if a prompt together with the system message would not fit in the context window.
+        """
+        self._log(f"Got a prompt with {msg_tokens} tokens.")
+
+        if msg_tokens + self._system_msg_tokens > self._token_trim * self._n_ctx:
+            raise MaxCtxWindow(f"Message {msg} has {msg_tokens} exceeds maximum context window.")
+
+    def _pop_oldest_message(self) -> None:
+        """
+        Removes the oldest message in the history, never removing the system message.
+        """
+        if self._messages[0]["role"] != "system":
+            self._messages.pop(0)
+        else:
+            self._messages.pop(1)
+
+    @contextmanager
+    def _track_request(self, streamed: bool = False):
+        """
+        Records how long generating a response took and whether it succeeded. Wrap the call to the backend with it.
+        Streamed requests should record their time to first token themselves. For the others it is the whole
+        response time, as that is when the first token arrives.
+        """
+        if not metrics.REGISTRY.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            metrics.LLM_REQUESTS_TOTAL.inc(backend=self.backend_name, status="error")
+            raise
+
+        elapsed = time.perf_counter() - start
+        metrics.LLM_REQUEST_SECONDS.observe(elapsed, backend=self.backend_name)
+        if not streamed:
+            metrics.LLM_TIME_TO_FIRST_TOKEN_SECONDS.observe(elapsed, backend=self.backend_name)
+        metrics.LLM_REQUESTS_TOTAL.inc(backend=self.backend_name, status="ok")
+
+    def _log_fill(self, cur_token: int, fill_amount: float, popped: bool = False) -> None:
+        if popped:
+            self._log(f"Popped a message! Token count is now {cur_token}. "
+                      f"Context Fill % is {fill_amount * 100:.2f}%.")
+        else:
+            self._log(f"Current token count in history is {cur_token}. "
+                      f"Context Fill % is {fill_amount * 100:.2f}%.")
+
     def ask(self, msg: str) -> tuple[str, dict[str, int]]:
         """
         Asks the LLM a question. The response is then returned.
-        Note: Implementation should use _prep_ask method to validate the message.
 
         :param msg: The question to ask the LLM.
         :return: The LLM's response in the following format (response, token_usage_info).
         """
-        raise NotImplementedError("Method ask is not implemented.")
+        # Validate input message and perform message trimming if we have too many tokens
+        self._prep_ask(msg)
+
+        # Get a response and append it to the message history
+        response, usage = self.complete(self._messages)
+        self.add_message("assistant", response)
+
+        return response, usage
+
+    async def ask_async(self, msg: str) -> tuple[str, dict[str, int]]:
+        """
+        Async version of ask. Token counting and the response are awaited so the event loop is free meanwhile.
+
+        :param msg: The question to ask the LLM.
+        :return: The LLM's response in the following format (response, token_usage_info).
+        """
+        await self._prep_ask_async(msg)
+
+        response, usage = await self.complete_async(self._messages)
+        self.add_message("assistant", response)
+
+        return response, usage
+
+    def ask_stream_async(self, msg: str) -> ResponseStream:
+        """
+        Asks the LLM a question, giving back the response piece by piece as it is generated. The request is only
+        made once the returned stream is iterated.
+
+        :param msg: The question to ask the LLM.
+        :return: A ResponseStream yielding the pieces of the response.
+        """
+        stream = ResponseStream()
+        stream._deltas = self._stream_response(msg, stream)
+
+        return stream
+
+    async def _stream_response(self, msg: str, stream: ResponseStream) -> AsyncIterator[str]:
+        """
+        Yields the pieces of the response to msg, adding the response to the message history once it is complete.
+        """
+        await self._prep_ask_async(msg)
+
+        parts = []
+        async for delta in self.complete_stream(self._messages, stream):
+            parts.append(delta)
+            yield delta
+
+        self.add_message("assistant", "".join(parts))
+
+    @abstractmethod
+    def complete(self, messages: list[dict[str, str]]) -> tuple[str, dict[str, int]]:
+        """
+        Gets the LLM's response to a conversation without touching our own message history. Implementations should
+        wrap the request to their backend with _track_request.
+
+        :param messages: The conversation to respond to.
+        :return: The LLM's response in the following format (response, token_usage_info).
+        """
+        raise NotImplementedError("Method complete is not implemented.")
+
+    async def complete_async(self, messages: list[dict[str, str]]) -> tuple[str, dict[str, int]]:
+        """
+        Async version of complete. By default, the blocking complete is run in a worker thread. Implementations with
+        an async client should override this.
+        """
+        return await asyncio.to_thread(self.complete, messages)
+
+    async def complete_stream(self, messages: list[dict[str, str]], stream: ResponseStream) -> AsyncIterator[str]:
+        """
+        Yields the pieces of the response to a conversation as they are generated, setting stream.usage once done.
+        Implementations that can stream from their backend should override this. By default, the whole response is
+        yielded at once, and its time to first token is recorded by complete_async.
+        """
+        response, usage = await self.complete_async(messages)
+        stream.usage = usage
+
+        yield response
+
+    @abstractmethod
+    def count_tokens(self, messages: list[dict[str, str]]) -> int:
+        """
+        Gets the number of prompt tokens a conversation takes up.
+        """
+        raise NotImplementedError("Method count_tokens is not implemented.")
+
+    async def count_tokens_async(self, messages: list[dict[str, str]]) -> int:
+        """
+        Async version of count_tokens. Runs the blocking version in a worker thread unless overridden.
+        """
+        return await asyncio.to_thread(self.count_tokens, messages)
 
     def save_history(self, filepath: str) -> None:
         """
@@ -200,19 +456,29 @@ class BaseLLM(ABC):
         with open(filepath, "w", encoding="utf-8") as file:
             json.dump(self._messages, file, ensure_ascii=False, indent=4)
 
-    @abstractmethod
     def get_token_count(self) -> int:
         """
         Gets the current token count of the message history.
         """
-        raise NotImplementedError("Method get_token_count is not implemented.")
+        return self.count_tokens(self._messages)
+
+    async def get_token_count_async(self) -> int:
+        """
+        Async version of get_token_count.
+        """
+        return await self.count_tokens_async(self._messages)
 
-    @abstractmethod
     def get_token_msg(self, msg: str, role: str = "user") -> int:
         """
         Gets the token count of a provided message.
         """
-        raise NotImplementedError("Method get_token_msg is not implemented.")
+        return self.count_tokens([{"role": role, "content": msg}])
+
+    async def get_token_msg_async(self, msg: str, role: str = "user") -> int:
+        """
+        Async version of get_token_msg.
+        """
+        return await self.count_tokens_async([{"role": role, "content": msg}])
 
     def _log(self, *args) -> None:
         if self._verbose:
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+from typing import Optional, Callable
+from src.config import Config
+from .base_llm import BaseLLM
+from .local_llm import LocalLLMManager
+from .remote_llm import RemoteLLMManager
+from .router_llm import RouterLLMManager, BackendPool
+
+
+def create_llm_manager(config: Config) -> BaseLLM:
+    """
+    Creates the LLM manager described by the config. A single API gets a RemoteLLMManager. Several APIs in
+    AI_API_URLS, or a GGUF model in AI_LOCAL_MODEL_PATH to fall back on, get a RouterLLMManager over all of them.
+    """
+    if len(config.api_urls) <= 1 and config.local_model_path is None:
+        api_url = config.api_urls[0] if config.api_urls else None
+        return RemoteLLMManager(config.llm_model, config.api_key, api_url, system_message=config.system_message,
+                                verbose=config.verbose, n_ctx=config.n_ctx, timeout=config.llm_timeout)
+
+    # Only the router holds the conversation, so the backends get no system message and can be shared by every
+    # router in the process. Failed requests are retried on the next backend instead of the same one.
+    backends = [_get_remote_backend(config.llm_model, config.api_key, api_url, config.n_ctx, config.llm_timeout,
+                                    config.verbose)
+                for api_url in config.api_urls]
+
+    fallbacks = []
+    if config.local_model_path is not None:
+        fallbacks.append(_get_local_backend(config.local_model_path, config.n_ctx or 512, config.verbose))
+
+    pool = _get_pool(backends, fallbacks, config.llm_timeout)
+    return RouterLLMManager(system_message=config.system_message, n_ctx=config.n_ctx, verbose=config.verbose,
+                            pool=pool)
+
+
+def get_backend_status() -> list[dict[str, int | bool | str]]:
+    """
+    Returns the name, outstanding requests, consecutive failures and health of every router backend created so far.
+    Empty when no router is in use.
+    """
+    with _backends_lock:
+        pools = list(_pools.values())
+
+    return [status for pool in pools for status in pool.get_status()]
+
+
+async def monitor_backends(interval: float) -> None:
+    """
+    Probes every router backend every interval seconds until cancelled, so a backend that went down is skipped
+    before a request has to wait on it, and one that came back is used again without waiting out its cooldown.
+    """
+    while True:
+        await asyncio.sleep(interval)
+
+        with _backends_lock:
+            pools = list(_pools.values())
+
+        for pool in pools:
+            try:
+                await pool.check_health()
+            except Exception as e:
+                print(f"[LLM] Could not check the health of the LLM backends: {e!r}")
+
+
+# Router backends by the settings they were created with. Loading a GGUF model takes seconds and a lot of memory,
+# so every character and the bot share one copy of each.
+_backends: dict[tuple, BaseLLM] = {}
+_pools: dict[tuple, BackendPool] = {}
+
+# Only ever held briefly, as the event loop takes it to get the status of the backends
+_backends_lock = threading.Lock()
+
+# Held while the backend with the same settings is created, so two characters connecting at once do not both load it
+_creation_locks: dict[tuple, threading.Lock] = {}
+
+
+def _get_remote_backend(model: str, api_key: str, api_url: Optional[str], n_ctx: Optional[int],
+                        timeout: Optional[float], verbose: bool) -> BaseLLM:
+    key = ("remote", model, api_key, api_url, n_ctx, timeout, verbose)
+
+    return _get_backend(key, lambda: RemoteLLMManager(model, api_key, api_url, verbose=verbose, n_ctx=n_ctx,
+                                                      timeout=timeout, max_retries=0))
+
+
+def _get_local_backend(filepath: str, n_ctx: int, verbose: bool) -> BaseLLM:
+    key = ("local", filepath, n_ctx, verbose)
+
+    return _get_backend(key, lambda: LocalLLMManager(filepath, n_ctx=n_ctx, verbose=verbose))
+
+
+def _get_backend(key: tuple, create: Callable[[], BaseLLM]) -> BaseLLM:
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is not None:
+            return backend
+
+        creation_lock = _creation_locks.setdefault(key, threading.Lock())
+
+    with creation_lock:
+        with _backends_lock:
+            backend = _backends.get(key)
+
+        if backend is None:
+            backend = create()
+            with _backends_lock:
+                _backends[key] = backend
+
+    return backend
+
+
+def _get_pool(backends: list[BaseLLM], fallbacks: list[BaseLLM], timeout: Optional[float]) -> BackendPool:
+    # Shared along with the backends, so every router sees the same failures and outstanding requests
+    key = (tuple(id(llm) for llm in backends), tuple(id(llm) for llm in fallbacks), timeout)
+
+    with _backends_lock:
+        if key not in _pools:
+            pool_args = {"timeout": timeout} if timeout is not None else {}
+            _pools[key] = BackendPool(backends, fallbacks, **pool_args)
+
+        return _pools[key]
@@ -14,3 +14,9 @@ class MaxCtxWindow(LLMManagerBaseException):
     """
     Raised when the context window is exceeded by having the prompt be too large
     """
+
+
+class NoBackendAvailable(LLMManagerBaseException):
+    """
+    Raised when a router could not get an answer from any of its backends
+    """
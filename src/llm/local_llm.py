@@ -1,9 +1,12 @@
+import os
+import threading
 from typing import Optional
-from llama_cpp import Llama
 from .base_llm import BaseLLM
 
 
 class LocalLLMManager(BaseLLM):
+    backend_name = "local"
+
     def __init__(self, filepath: str, n_gpu_layers: int = -1, system_message: Optional[str] = None,
                  n_ctx: int = 512, temperature: float = 1.0, token_trim: float = 0.9,
                  verbose: bool = False, history_file: Optional[str] = None) -> None:
@@ -19,41 +22,38 @@ class LocalLLMManager(BaseLLM):
         :param verbose: Sets whether we print helpful debug messages to the console.
         :param history_file: Conversation JSON file to import if applicable.
         """
-        # Initialize Llama CPP for a Local LLM
+        # Initialize Llama CPP for a Local LLM. It is imported here as loading the library is slow.
+        from llama_cpp import Llama
         self._llm = Llama(model_path=filepath, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
+        self._model_name = os.path.basename(filepath)
+
+        # The async methods run in worker threads, but a llama.cpp context can only be used by one thread at a time
+        self._llm_lock = threading.Lock()
 
         super().__init__(system_message, n_ctx, temperature, token_trim, verbose, history_file)
 
-    def ask(self, msg: str) -> tuple[str, dict[str, int]]:
+    @property
+    def model_name(self) -> str:
+        return self._model_name
+
+    def complete(self, messages: list[dict[str, str]]) -> tuple[str, dict[str, int]]:
         """
-        Asks the LLM a question. The response is then returned.
+        Gets the model's response to a conversation without touching our own message history.
 
-        :param msg: The question to ask the LLM.
+        :param messages: The conversation to respond to.
         :return: The LLM's response in the following format (response, token_usage_info).
         """
-        # Validate input message and perform message trimming if we have too many tokens
-        self._prep_ask(msg)
-
-        # Get a response
-        completion = self._llm.create_chat_completion(messages=self._messages, temperature=self._temperature)
-
-        # Append the response to the message history
-        self._messages.append(completion["choices"][0]["message"])
+        with self._track_request(), self._llm_lock:
+            completion = self._llm.create_chat_completion(messages=messages, temperature=self._temperature)
 
         return completion["choices"][0]["message"]["content"], completion["usage"]
 
-    def get_token_count(self) -> int:
-        """
-        Gets the current token count in the message history.
-        """
-        return self._llm.create_chat_completion(messages=self._messages, max_tokens=0)["usage"]["prompt_tokens"]
-
-    def get_token_msg(self, msg: str, role: str = "user") -> int:
+    def count_tokens(self, messages: list[dict[str, str]]) -> int:
         """
-        Gets the token count of a provided message.
+        Gets the number of prompt tokens a conversation takes up.
         """
-        temp_message = [{"role": role, "content": msg}]
-        return self._llm.create_chat_completion(messages=temp_message, max_tokens=0)["usage"]["prompt_tokens"]
+        with self._llm_lock:
+            return self._llm.create_chat_completion(messages=messages, max_tokens=0)["usage"]["prompt_tokens"]
 
 
 if __name__ == "__main__":
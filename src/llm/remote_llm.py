@@ -1,12 +1,16 @@
-from openai import OpenAI
-from typing import Optional
-from .base_llm import BaseLLM
+import time
+from typing import Optional, AsyncIterator
+from src.telemetry import metrics
+from .base_llm import BaseLLM, ResponseStream
 
 
 class RemoteLLMManager(BaseLLM):
+    backend_name = "remote"
+
     def __init__(self, model: str, api_key: str, api_url: Optional[str] = None, system_message: Optional[str] = None,
                  n_ctx: Optional[int] = None, temperature: float = 1.0, token_trim: float = 0.9,
-                 verbose: bool = False, history_file: Optional[str] = None) -> None:
+                 verbose: bool = False, history_file: Optional[str] = None, timeout: Optional[float] = None,
+                 max_retries: Optional[int] = None) -> None:
         """
         Initializes the remote LLM class that connects to an OpenAI compatible API.
 
@@ -19,9 +23,16 @@ class RemoteLLMManager(BaseLLM):
         :param token_trim: Sets the point of how full the context window should be until we start trimming old messages.
         :param verbose: Sets whether we print helpful debug messages to the console.
         :param history_file: Conversation JSON file to import if applicable.
+        :param timeout: How long to wait in seconds for a request to the API. Defaults to the openai client's timeout.
+        :param max_retries: How many times a failed request is retried. Defaults to the openai client's retries.
         """
-        # Connect to the API
-        self._llm = OpenAI(api_key=api_key, base_url=api_url)
+        # Connect to the API. The async client is used by the *_async methods so callers on an event loop never block.
+        # The openai package takes most of a second to import, so it is only loaded once a manager is needed.
+        from openai import OpenAI, AsyncOpenAI
+        client_args = {name: value for name, value in (("timeout", timeout), ("max_retries", max_retries))
+                       if value is not None}
+        self._llm = OpenAI(api_key=api_key, base_url=api_url, **client_args)
+        self._async_llm = AsyncOpenAI(api_key=api_key, base_url=api_url, **client_args)
         self._model = model
 
         # RemoteLLMManager should almost certainly have n_ctx set
@@ -31,40 +42,72 @@ class RemoteLLMManager(BaseLLM):
 
         super().__init__(system_message, n_ctx, temperature, token_trim, verbose, history_file)
 
-    def ask(self, msg: str) -> tuple[str, dict[str, int]]:
+    @property
+    def model_name(self) -> str:
+        return self._model
+
+    def complete(self, messages: list[dict[str, str]]) -> tuple[str, dict[str, int]]:
         """
-        Asks the LLM a question. The response is then returned.
+        Gets the API's response to a conversation without touching our own message history.
 
-        :param msg: The question to ask the LLM.
+        :param messages: The conversation to respond to.
         :return: The LLM's response in the following format (response, token_usage_info).
         """
-        # Validate input message and perform message trimming if we have too many tokens
-        self._prep_ask(msg)
+        with self._track_request():
+            completion = self._llm.chat.completions.create(messages=messages,
+                                                           model=self._model, temperature=self._temperature).to_dict()
 
-        # Get a response
-        completion = self._llm.chat.completions.create(messages=self._messages,
-                                                       model=self._model, temperature=self._temperature).to_dict()
+        return completion["choices"][0]["message"]["content"], completion["usage"]
 
-        # Append the response to the message history
-        self._messages.append(completion["choices"][0]["message"])
+    async def complete_async(self, messages: list[dict[str, str]]) -> tuple[str, dict[str, int]]:
+        """
+        Gets the API's response to a conversation using the async client.
+        """
+        with self._track_request():
+            completion = (await self._async_llm.chat.completions.create(messages=messages, model=self._model,
+                                                                        temperature=self._temperature)).to_dict()
 
         return completion["choices"][0]["message"]["content"], completion["usage"]
 
-    def get_token_count(self) -> int:
+    async def complete_stream(self, messages: list[dict[str, str]], stream: ResponseStream) -> AsyncIterator[str]:
         """
-        Gets the current token count in the message history.
+        Streams the API's response to a conversation, setting stream.usage once done.
         """
-        return self._llm.chat.completions.create(messages=self._messages,
-                                                 model=self._model, max_tokens=0).to_dict()["usage"]["prompt_tokens"]
+        first = True
+
+        with self._track_request(streamed=True):
+            start = time.perf_counter()
+            chunks = await self._async_llm.chat.completions.create(messages=messages, model=self._model,
+                                                                   temperature=self._temperature, stream=True,
+                                                                   stream_options={"include_usage": True})
 
-    def get_token_msg(self, msg: str, role: str = "user") -> int:
+            async for chunk in chunks:
+                # Usage information comes in the last chunk, which has no choices
+                if chunk.usage is not None:
+                    stream.usage = chunk.usage.to_dict()
+
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    if first:
+                        metrics.LLM_TIME_TO_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start,
+                                                                     backend=self.backend_name)
+                        first = False
+
+                    yield chunk.choices[0].delta.content
+
+    def count_tokens(self, messages: list[dict[str, str]]) -> int:
         """
-        Gets the token count of a provided message.
+        Gets the number of prompt tokens a conversation takes up.
         """
-        temp_message = [{"role": role, "content": msg}]
-        return self._llm.chat.completions.create(messages=temp_message,
+        return self._llm.chat.completions.create(messages=messages,
                                                  model=self._model, max_tokens=0).to_dict()["usage"]["prompt_tokens"]
 
+    async def count_tokens_async(self, messages: list[dict[str, str]]) -> int:
+        """
+        Gets the number of prompt tokens a conversation takes up using the async client.
+        """
+        completion = await self._async_llm.chat.completions.create(messages=messages, model=self._model, max_tokens=0)
+        return completion.to_dict()["usage"]["prompt_tokens"]
+
 
 if __name__ == "__main__":
     """
@@ -0,0 +1,329 @@
+import time
+import asyncio
+import threading
+from typing import Optional, AsyncIterator, Sequence, Callable, Awaitable, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from src.telemetry import metrics
+from .base_llm import BaseLLM, ResponseStream
+from .llmexceptions import NoBackendAvailable
+
+T = TypeVar("T")
+
+# Sent to backends by check_health. Counting its tokens is about the cheapest request an LLM API can answer.
+_PROBE_MESSAGES = [{"role": "user", "content": "ping"}]
+
+
+class _Backend:
+    """
+    What the router keeps track of for each of its backends.
+    """
+
+    def __init__(self, llm: BaseLLM, name: str, fallback: bool) -> None:
+        self.llm = llm
+        self.name = name
+        self.fallback = fallback
+
+        self.outstanding: int = 0
+        self.failures: int = 0
+        self.last_picked: float = 0.0
+        self.unhealthy_until: float = 0.0
+
+
+class BackendPool:
+    """
+    A set of LLM backends and how healthy each one is, shared by every router that uses them so they all see the
+    same outstanding requests and failures.
+
+    Requests go to the healthy backend with the fewest outstanding requests. Fallback backends (for example a local
+    GGUF model behind remote APIs) are only tried once every primary backend has failed. A backend that fails
+    max_failures times in a row is skipped for cooldown seconds, after which it is given another chance, or sooner
+    if check_health finds it answering again.
+    """
+
+    def __init__(self, backends: Sequence[BaseLLM], fallbacks: Sequence[BaseLLM] = (), timeout: float = 60.0,
+                 max_failures: int = 3, cooldown: float = 30.0) -> None:
+        """
+        :param backends: The backends to balance requests over.
+        :param fallbacks: Backends only used once every one of the backends has failed.
+        :param timeout: How long to wait in seconds for a backend to answer, or for the next piece of a streamed
+                        response, before moving on to the next backend.
+        :param max_failures: How many times in a row a backend may fail before it is skipped.
+        :param cooldown: How long in seconds a failing backend is skipped for.
+        """
+        all_backends = list(backends) + list(fallbacks)
+        if len(all_backends) == 0:
+            raise ValueError("A backend pool needs at least one backend.")
+
+        self.backends = [_Backend(llm, f"{llm.backend_name}[{idx}] {llm.model_name}", idx >= len(backends))
+                         for idx, llm in enumerate(all_backends)]
+        self.timeout = timeout
+        self._max_failures = max_failures
+        self._cooldown = cooldown
+
+        # Blocking calls run here so they can be given up on once they time out
+        self.executor = ThreadPoolExecutor(thread_name_prefix="llm-router")
+        self._state_lock = threading.Lock()
+
+    @property
+    def n_ctx(self) -> int:
+        """
+        The smallest context window of all backends.
+        """
+        return min(backend.llm._n_ctx for backend in self.backends)
+
+    async def check_health(self) -> dict[str, bool]:
+        """
+        Sends a small request to every backend, returning whether each one answered. Backends that answer are used
+        again right away instead of waiting out their cooldown, so this can be run periodically.
+        """
+        async def probe(backend: _Backend) -> bool:
+            try:
+                await asyncio.wait_for(backend.llm.count_tokens_async(_PROBE_MESSAGES), self.timeout)
+            except Exception as e:
+                self.record(backend, False, e)
+                return False
+
+            self.record(backend, True)
+            return True
+
+        results = await asyncio.gather(*(probe(backend) for backend in self.backends))
+        return {backend.name: healthy for backend, healthy in zip(self.backends, results)}
+
+    def get_status(self) -> list[dict[str, int | bool | str]]:
+        """
+        Returns the name, outstanding requests, consecutive failures and health of every backend.
+        """
+        now = time.monotonic()
+
+        with self._state_lock:
+            return [{"name": backend.name, "outstanding": backend.outstanding, "failures": backend.failures,
+                     "healthy": backend.unhealthy_until <= now} for backend in self.backends]
+
+    def candidates(self) -> list[_Backend]:
+        """
+        Orders the backends in which they should be tried for a request: healthy backends before healthy fallbacks,
+        each by fewest outstanding requests and then least recently picked. Unhealthy backends come last, so a
+        request is still attempted when every backend is cooling down.
+        """
+        now = time.monotonic()
+
+        with self._state_lock:
+            return sorted(self.backends, key=lambda backend: (backend.unhealthy_until > now, backend.fallback,
+                                                              backend.outstanding, backend.last_picked))
+
+    def acquire(self, backend: _Backend) -> None:
+        with self._state_lock:
+            backend.outstanding += 1
+            backend.last_picked = time.monotonic()
+
+    def release(self, backend: _Backend) -> None:
+        with self._state_lock:
+            backend.outstanding -= 1
+
+    def record(self, backend: _Backend, succeeded: bool, error: Optional[Exception] = None) -> None:
+        """
+        Updates the health of a backend after a request to it finished.
+        """
+        with self._state_lock:
+            if succeeded:
+                backend.failures = 0
+                backend.unhealthy_until = 0.0
+                return
+
+            backend.failures += 1
+            if backend.failures >= self._max_failures:
+                backend.unhealthy_until = time.monotonic() + self._cooldown
+
+        print(f"[BackendPool] Backend {backend.name} failed {backend.failures} time(s) in a row: {error!r}")
+
+
+class RouterLLMManager(BaseLLM):
+    """
+    Spreads requests over several LLM backends. The router keeps the conversation history itself and only has the
+    backends complete it, so any backend can answer any request. Which backend is asked is decided by a
+    BackendPool, which several routers can share.
+    """
+    backend_name = "router"
+
+    def __init__(self, backends: Sequence[BaseLLM] = (), fallbacks: Sequence[BaseLLM] = (),
+                 system_message: Optional[str] = None, n_ctx: Optional[int] = None, token_trim: float = 0.9,
+                 verbose: bool = False, history_file: Optional[str] = None, timeout: float = 60.0,
+                 max_failures: int = 3, cooldown: float = 30.0, pool: Optional[BackendPool] = None) -> None:
+        """
+        Initializes the router. Backends should be created without a system message or history, as only the
+        router's own history is sent to them. Each backend keeps its own temperature.
+
+        :param backends: The backends to balance requests over.
+        :param fallbacks: Backends only used once every one of the backends has failed.
+        :param system_message: The initial system message provided to the LLM.
+        :param n_ctx: Size of the context window. Defaults to the smallest context window of all backends.
+        :param token_trim: Sets the point of how full the context window should be until we start trimming old messages.
+        :param verbose: Sets whether we print helpful debug messages to the console.
+        :param history_file: Conversation JSON file to import if applicable.
+        :param timeout: How long to wait in seconds for a backend to answer, or for the next piece of a streamed
+                        response, before moving on to the next backend.
+        :param max_failures: How many times in a row a backend may fail before it is skipped.
+        :param cooldown: How long in seconds a failing backend is skipped for.
+        :param pool: A pool shared with other routers to use instead of the backends, fallbacks, timeout,
+                     max_failures and cooldown.
+        """
+        if pool is None:
+            pool = BackendPool(backends, fallbacks, timeout, max_failures, cooldown)
+
+        self._pool = pool
+        self._last_backend: _Backend = pool.backends[0]
+
+        super().__init__(system_message, n_ctx if n_ctx is not None else pool.n_ctx, 1.0, token_trim, verbose,
+                         history_file)
+
+    @property
+    def model_name(self) -> str:
+        """
+        Name of the model that answered last.
+        """
+        return self._last_backend.llm.model_name
+
+    @property
+    def pool(self) -> BackendPool:
+        return self._pool
+
+    def complete(self, messages: list[dict[str, str]]) -> tuple[str, dict[str, int]]:
+        """
+        Gets a response to a conversation from the first backend able to give one.
+
+        :param messages: The conversation to respond to.
+        :return: The LLM's response in the following format (response, token_usage_info).
+        """
+        return self._route(lambda llm: llm.complete(messages))
+
+    async def complete_async(self, messages: list[dict[str, str]]) -> tuple[str, dict[str, int]]:
+        """
+        Async version of complete.
+        """
+        return await self._route_async(lambda llm: llm.complete_async(messages))
+
+    async def complete_stream(self, messages: list[dict[str, str]], stream: ResponseStream) -> AsyncIterator[str]:
+        """
+        Streams a response to a conversation from the first backend able to give one. Once a backend has sent part
+        of its response, it can no longer be handed to another backend, so later failures are raised.
+        """
+        pool = self._pool
+        last_error: Optional[Exception] = None
+
+        for backend in pool.candidates():
+            self._log_failover(backend, last_error)
+            pool.acquire(backend)
+
+            deltas = backend.llm.complete_stream(messages, stream)
+            started = False
+
+            try:
+                while True:
+                    try:
+                        delta = await asyncio.wait_for(deltas.__anext__(), pool.timeout)
+                    except StopAsyncIteration:
+                        break
+
+                    started = True
+                    yield delta
+            except Exception as e:
+                pool.record(backend, False, e)
+                if started:
+                    raise
+
+                last_error = e
+                continue
+            finally:
+                pool.release(backend)
+                await deltas.aclose()
+
+            self._succeeded(backend)
+            return
+
+        raise NoBackendAvailable("No LLM backend was able to answer.") from last_error
+
+    def count_tokens(self, messages: list[dict[str, str]]) -> int:
+        """
+        Gets the number of prompt tokens a conversation takes up. Counted by whichever backend is available, so
+        backends should share a tokenizer for the count to be exact.
+        """
+        return self._route(lambda llm: llm.count_tokens(messages))
+
+    async def count_tokens_async(self, messages: list[dict[str, str]]) -> int:
+        """
+        Async version of count_tokens.
+        """
+        return await self._route_async(lambda llm: llm.count_tokens_async(messages))
+
+    async def check_health(self) -> dict[str, bool]:
+        """
+        Probes every backend of the pool. See BackendPool.check_health.
+        """
+        return await self._pool.check_health()
+
+    def get_backend_status(self) -> list[dict[str, int | bool | str]]:
+        """
+        Returns the name, outstanding requests, consecutive failures and health of every backend.
+        """
+        return self._pool.get_status()
+
+    def _route(self, call: Callable[[BaseLLM], T]) -> T:
+        """
+        Makes a blocking call on one backend after another until one succeeds within the timeout.
+        """
+        pool = self._pool
+        last_error: Optional[Exception] = None
+
+        for backend in pool.candidates():
+            self._log_failover(backend, last_error)
+            pool.acquire(backend)
+
+            # A timed out call keeps running in its thread, and counts as outstanding until it is done
+            future = pool.executor.submit(call, backend.llm)
+            future.add_done_callback(lambda _, backend=backend: pool.release(backend))
+
+            try:
+                result = future.result(timeout=pool.timeout)
+            except Exception as e:
+                pool.record(backend, False, e)
+                last_error = e
+                continue
+
+            self._succeeded(backend)
+            return result
+
+        raise NoBackendAvailable("No LLM backend was able to answer.") from last_error
+
+    async def _route_async(self, call: Callable[[BaseLLM], Awaitable[T]]) -> T:
+        """
+        Awaits a call on one backend after another until one succeeds within the timeout.
+        """
+        pool = self._pool
+        last_error: Optional[Exception] = None
+
+        for backend in pool.candidates():
+            self._log_failover(backend, last_error)
+            pool.acquire(backend)
+
+            try:
+                result = await asyncio.wait_for(call(backend.llm), pool.timeout)
+            except Exception as e:
+                pool.record(backend, False, e)
+                last_error = e
+                continue
+            finally:
+                pool.release(backend)
+
+            self._succeeded(backend)
+            return result
+
+        raise NoBackendAvailable("No LLM backend was able to answer.") from last_error
+
+    def _succeeded(self, backend: _Backend) -> None:
+        self._pool.record(backend, True)
+        self._last_backend = backend
+
+    def _log_failover(self, backend: _Backend, last_error: Optional[Exception]) -> None:
+        if last_error is not None:
+            metrics.LLM_FAILOVERS_TOTAL.inc(backend=backend.name)
+            self._log(f"Failing over to {backend.name}.")
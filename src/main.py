@@ -1,24 +1,27 @@
-import os
-import dotenv
 import logging
 from jbot import JAIBot
+from src.config import Config, get_config
+from src.telemetry import metrics
 
 
-COGS = [
-    "src.jbot.cogs.ai_interactions",
-    "src.jbot.cogs.test"
-]
+def create_bot(config: Config) -> JAIBot:
+    """
+    Creates the bot with the cogs listed in JBOT_COGS (all of them by default) loaded.
+    """
+    metrics.REGISTRY.enabled = config.metrics_enabled
 
+    bot = JAIBot()
 
-# Start the bot
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO)
+    for cog in config.cogs:
+        bot.load_extension(cog)
 
-    dotenv.load_dotenv(dotenv.find_dotenv())
+    return bot
 
-    bot = JAIBot()
 
-    for cog in COGS:
-        bot.load_extension(cog)
+# Start the bot
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
 
-    bot.run(str(os.getenv("DISCORD_TOKEN")))
+    config = get_config()
+    bot = create_bot(config)
+    bot.run(str(config.discord_token))
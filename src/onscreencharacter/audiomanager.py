@@ -1,6 +1,10 @@
 import os
 import time
-import pygame
+from typing import Optional, Callable, TYPE_CHECKING
+from src.telemetry import metrics
+
+if TYPE_CHECKING:
+    from .audioprocessing import AudioProcessor, ProcessedAudio
 
 
 class AudioManager:
@@ -8,33 +12,113 @@ class AudioManager:
     Class for playing audio files using PyGame.
     """
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, processor: Optional["AudioProcessor"] = None):
+        """
+        :param verbose: Sets whether we print helpful debug messages to the console.
+        :param processor: Post-processes files before they are played. Files are played as they are without one.
+        """
+        # Imported here as loading PyGame is slow
+        import pygame
         self.verbose = verbose
+        self.processor = processor
 
         # Initialize pygame audio mixer
         pygame.mixer.init()
 
+    def prepare(self, filename: str, delete_file: bool = True) -> Optional["ProcessedAudio"]:
+        """
+        Decodes and processes a file ahead of playing it with play_audio. Returns None if there is no processor or
+        the file could not be processed, in which case it should be played with play instead and is not deleted.
+        """
+        if self.processor is None:
+            return None
+
+        self._init_mixer()
+
+        try:
+            audio = self.processor.process(filename)
+        except Exception as e:
+            self._log(f"{filename} could not be processed, it will be played as is. {e}")
+            return None
+
+        if delete_file:
+            self._delete(filename)
+
+        return audio
+
     def play(self, filename: str, delete_file: bool = True):
-        if pygame.mixer.get_init() is None:
-            self._log("Audio mixer was not initialized. Initializing audio mixer.")
-            pygame.mixer.init()
+        import pygame
+
+        self._init_mixer()
 
         self._log(f"Playing {filename}")
-        pygame.mixer.music.load(filename)
-        pygame.mixer.music.play()
+        with metrics.PLAYBACK_SECONDS.time():
+            pygame.mixer.music.load(filename)
+            pygame.mixer.music.play()
 
-        self._log("Waiting for file to finish playing.")
-        while pygame.mixer.music.get_busy():
-            time.sleep(0.1)
+            self._log("Waiting for file to finish playing.")
+            while pygame.mixer.music.get_busy():
+                time.sleep(0.1)
 
         self._log("File playing finished.")
 
         if delete_file:
-            try:
-                os.remove(filename)
-                self._log(f"{filename} was deleted.")
-            except Exception as e:
-                self._log(f"{filename} could not be deleted. {e}")
+            self._delete(filename)
+
+    def play_audio(self, audio: "ProcessedAudio", on_progress: Optional[Callable[[float], None]] = None,
+                   interval: float = 1 / 15):
+        """
+        Plays a processed clip, returning once it has finished.
+
+        :param audio: The clip to play.
+        :param on_progress: Called with the seconds played so far every interval seconds during playback, for
+                            anything that has to keep up with the audio. Calls that run long delay the next one
+                            instead of queueing up.
+        :param interval: Seconds between calls to on_progress.
+        """
+        import pygame
+        from .audioprocessing import match_channels
+
+        self._init_mixer()
+
+        # The mixer may have been opened with a different number of channels than the clip was decoded with
+        sound = pygame.sndarray.make_sound(match_channels(audio.samples, pygame.mixer.get_init()[2]))
+
+        self._log(f"Playing {audio.duration:.2f} seconds of processed audio.")
+        with metrics.PLAYBACK_SECONDS.time():
+            channel = pygame.mixer.find_channel(True)
+            channel.play(sound)
+            start = time.monotonic()
+
+            if on_progress is None:
+                # The length is known up front, so sleep through most of it and only poll closely near the end
+                time.sleep(max(0.0, audio.duration - 0.05))
+                while channel.get_busy():
+                    time.sleep(0.005)
+            else:
+                next_update = start
+                while channel.get_busy():
+                    on_progress(time.monotonic() - start)
+
+                    # Never sleeping past the end of the clip keeps the next one from being held up
+                    next_update = max(next_update + interval, time.monotonic())
+                    time.sleep(max(0.005, min(next_update, start + audio.duration) - time.monotonic()))
+
+        self._log("Audio playing finished.")
+
+    def _init_mixer(self):
+        import pygame
+
+        if pygame.mixer.get_init() is None:
+            self._log("Audio mixer was not initialized. Initializing audio mixer.")
+            pygame.mixer.init()
+
+    def _delete(self, filename: str):
+        try:
+            os.remove(filename)
+            self._log(f"{filename} was deleted.")
+        except Exception as e:
+            self._log(f"{filename} could not be deleted. {e}")
 
     def _log(self, *args):
         if self.verbose:
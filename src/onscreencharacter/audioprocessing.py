@@ -0,0 +1,334 @@
+"""
+Post-processing for synthesized speech: decodes a clip to PCM once, trims the silence around it, speeds it up
+without changing its pitch and evens out its loudness, so every clip sounds alike and takes less time to play.
+"""
+import io
+import hashlib
+import threading
+import numpy as np
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Optional
+
+from src.config import Config
+from src.telemetry import metrics
+
+# Length in seconds of the blocks loudness is measured over
+LEVEL_WINDOW_SECONDS = 0.02
+
+# Highest level in dBFS a normalized sample may reach, leaving headroom for resampling in the audio device
+PEAK_DBFS = -1.0
+
+# Quiet clips are never boosted by more than this many dB, so background noise is not blown up
+MAX_GAIN_DB = 20.0
+
+# Length in seconds of the blocks the amplitude envelope is made of, a little over one video frame at 30 fps
+ENVELOPE_SECONDS = 0.04
+
+
+@dataclass(frozen=True)
+class ProcessedAudio:
+    """
+    A processed clip as PCM samples in the format of the pygame mixer, shaped (frames, channels), along with its
+    amplitude envelope: the RMS level between 0 and 1 of every ENVELOPE_SECONDS of it.
+    """
+    samples: np.ndarray
+    sample_rate: int
+    envelope: np.ndarray
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+    @property
+    def envelope_rate(self) -> float:
+        """
+        Number of envelope values per second of audio.
+        """
+        return self.sample_rate / max(1, int(self.sample_rate * ENVELOPE_SECONDS))
+
+
+class AudioProcessor:
+    """
+    Turns synthesized speech files into processed PCM ready to be played by AudioManager. Processed clips are
+    cached by the contents of their file, so a response that is spoken again is not processed twice.
+    """
+
+    def __init__(self, tempo: float = 1.25, target_dbfs: Optional[float] = -20.0, silence_dbfs: float = -50.0,
+                 silence_padding: float = 0.05, cache_size: int = 16, verbose: bool = False) -> None:
+        """
+        :param tempo: How much faster to speak, keeping the pitch. 1.0 leaves the speed alone.
+        :param target_dbfs: Loudness of the speech in dBFS to normalize to, or None to keep the loudness.
+        :param silence_dbfs: Level in dBFS below which audio at the start and end of a clip is trimmed.
+        :param silence_padding: Seconds of the trimmed silence to keep on either side, so speech does not start
+                                or stop abruptly.
+        :param cache_size: How many processed clips to keep.
+        :param verbose: Sets whether we print helpful debug messages to the console.
+        """
+        if tempo <= 0:
+            raise ValueError("tempo must be greater than 0")
+
+        self.tempo = tempo
+        self.target_dbfs = target_dbfs
+        self.silence_dbfs = silence_dbfs
+        self.silence_padding = silence_padding
+        self.verbose = verbose
+
+        self._cache: OrderedDict[bytes, ProcessedAudio] = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Config) -> "AudioProcessor":
+        return cls(config.audio_tempo, config.audio_target_dbfs, config.audio_silence_dbfs, verbose=config.verbose)
+
+    def process(self, filename: str) -> ProcessedAudio:
+        """
+        Decodes and processes a clip. Needs the pygame mixer to be initialized, as clips are decoded to its format.
+        """
+        with open(filename, "rb") as clip:
+            data = clip.read()
+
+        key = hashlib.blake2b(data, digest_size=16).digest()
+
+        with self._cache_lock:
+            audio = self._cache.get(key)
+            if audio is not None:
+                self._cache.move_to_end(key)
+                self._log(f"Using the cached processing of {filename}.")
+                return audio
+
+        with metrics.AUDIO_PROCESSING_SECONDS.time():
+            audio = self.process_samples(*decode(data))
+
+        self._log(f"Processed {filename} down to {audio.duration:.2f} seconds.")
+
+        with self._cache_lock:
+            self._cache[key] = audio
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return audio
+
+    def process_samples(self, samples: np.ndarray, sample_rate: int) -> ProcessedAudio:
+        """
+        Processes PCM samples shaped (frames, channels), keeping them in the same format.
+        """
+        audio = to_float(samples)
+        audio = trim_silence(audio, sample_rate, self.silence_dbfs, self.silence_padding)
+        audio = change_tempo(audio, sample_rate, self.tempo)
+
+        if self.target_dbfs is not None:
+            audio = normalize_loudness(audio, sample_rate, self.target_dbfs, self.silence_dbfs)
+
+        return ProcessedAudio(from_float(audio, samples.dtype), sample_rate, amplitude_envelope(audio, sample_rate))
+
+    def _log(self, *args) -> None:
+        if self.verbose:
+            print("[AudioProcessor]", *args)
+
+
+def decode(data: bytes) -> tuple[np.ndarray, int]:
+    """
+    Decodes an audio file to PCM samples in the format of the pygame mixer, shaped (frames, channels).
+    Returns the samples and their sample rate.
+    """
+    # Imported here as loading PyGame is slow
+    import pygame
+
+    sample_rate = pygame.mixer.get_init()[0]
+    samples = pygame.sndarray.array(pygame.mixer.Sound(file=io.BytesIO(data)))
+
+    return samples.reshape(len(samples), -1), sample_rate
+
+
+def match_channels(samples: np.ndarray, channels: int) -> np.ndarray:
+    """
+    Mixes PCM samples shaped (frames, channels) up or down to the given number of channels, in the shape
+    pygame.sndarray.make_sound expects: (frames,) for mono and (frames, channels) otherwise.
+    """
+    if samples.shape[1] != channels:
+        if samples.shape[1] == 1:
+            samples = np.repeat(samples, channels, axis=1)
+        else:
+            mixed = from_float(to_float(samples).mean(axis=1, keepdims=True), samples.dtype)
+            samples = np.repeat(mixed, channels, axis=1)
+
+    if channels == 1:
+        samples = samples[:, 0]
+
+    return np.ascontiguousarray(samples)
+
+
+def to_float(samples: np.ndarray) -> np.ndarray:
+    """
+    Converts PCM samples to float32 between -1 and 1.
+    """
+    if samples.dtype.kind == "f":
+        return samples.astype(np.float32)
+
+    info = np.iinfo(samples.dtype)
+    scale = (int(info.max) - int(info.min) + 1) / 2
+    offset = (int(info.max) + int(info.min) + 1) / 2
+
+    return ((samples.astype(np.float32) - offset) / scale).astype(np.float32)
+
+
+def from_float(audio: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    Converts float samples between -1 and 1 back to PCM samples of the given type.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return np.ascontiguousarray(audio, dtype=dtype)
+
+    info = np.iinfo(dtype)
+    scale = (int(info.max) - int(info.min) + 1) / 2
+    offset = (int(info.max) + int(info.min) + 1) / 2
+
+    return np.ascontiguousarray(np.clip(np.rint(audio * scale + offset), info.min, info.max), dtype=dtype)
+
+
+def window_levels(audio: np.ndarray, window: int) -> np.ndarray:
+    """
+    Returns the mean square of each block of window frames across all channels, padding the last block with silence.
+    """
+    if len(audio) == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    n_windows = -(-len(audio) // window)
+    padded = np.zeros((n_windows * window, audio.shape[1]), dtype=np.float32)
+    padded[:len(audio)] = audio
+
+    return np.mean(np.square(padded.reshape(n_windows, -1)), axis=1)
+
+
+def amplitude_envelope(audio: np.ndarray, sample_rate: int) -> np.ndarray:
+    """
+    Returns the RMS level of every ENVELOPE_SECONDS of float audio.
+    """
+    if len(audio) == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    return np.sqrt(window_levels(audio, max(1, int(sample_rate * ENVELOPE_SECONDS))))
+
+
+def trim_silence(audio: np.ndarray, sample_rate: int, silence_dbfs: float, padding: float) -> np.ndarray:
+    """
+    Cuts the audio quieter than silence_dbfs off the start and end, keeping padding seconds of it on either side.
+    A clip that is quiet throughout is returned as is.
+    """
+    if len(audio) == 0:
+        return audio
+
+    window = max(1, int(sample_rate * LEVEL_WINDOW_SECONDS))
+    loud = np.flatnonzero(window_levels(audio, window) > _db_to_power(silence_dbfs))
+    if len(loud) == 0:
+        return audio
+
+    pad = int(sample_rate * padding)
+    start = max(0, loud[0] * window - pad)
+    end = min(len(audio), (loud[-1] + 1) * window + pad)
+
+    return audio[start:end]
+
+
+def normalize_loudness(audio: np.ndarray, sample_rate: int, target_dbfs: float, silence_dbfs: float) -> np.ndarray:
+    """
+    Scales the audio so its loudness, measured over the parts louder than silence_dbfs, reaches target_dbfs.
+    The gain is capped so no sample rises above PEAK_DBFS and quiet clips are not boosted by more than MAX_GAIN_DB.
+    """
+    if len(audio) == 0:
+        return audio
+
+    window = max(1, int(sample_rate * LEVEL_WINDOW_SECONDS))
+    levels = window_levels(audio, window)
+    active = levels[levels > _db_to_power(silence_dbfs)]
+    peak = float(np.max(np.abs(audio)))
+    if len(active) == 0 or peak == 0.0:
+        return audio
+
+    loudness_db = 10 * np.log10(np.mean(active))
+    gain_db = min(target_dbfs - loudness_db, PEAK_DBFS - 20 * np.log10(peak), MAX_GAIN_DB)
+
+    return audio * np.float32(10 ** (gain_db / 20))
+
+
+def change_tempo(audio: np.ndarray, sample_rate: int, tempo: float, frame_seconds: float = 0.03,
+                 search_seconds: float = 0.01) -> np.ndarray:
+    """
+    Speeds audio up (or slows it down) by tempo without changing its pitch, using waveform similarity overlap-add
+    (WSOLA). The output is built from windowed frames half a frame apart. Each frame is read from the input near
+    where the tempo puts it, shifted by up to search_seconds to where it lines up best with the end of the previous
+    frame, which keeps voices from sounding phasey.
+    """
+    frame = 2 * max(1, int(sample_rate * frame_seconds) // 2)
+    if tempo == 1.0 or len(audio) < frame:
+        return audio
+
+    hop = frame // 2
+    search = int(sample_rate * search_seconds)
+    n_channels = audio.shape[1]
+
+    # Frames are first lined up roughly on a mono signal at around 8 kHz, then to the exact frame around that
+    step = max(1, sample_rate // 8000)
+    mono = audio.mean(axis=1)
+    coarse = mono[:len(mono) // step * step].reshape(-1, step).mean(axis=1)
+    coarse_frame = frame // step
+    coarse_search = search // step
+
+    # Silence around the input keeps every candidate frame in bounds
+    margin = search + step
+    padded = np.zeros((margin + len(audio) + frame + margin, n_channels), dtype=np.float32)
+    padded[margin:margin + len(audio)] = audio
+    padded_mono = padded.mean(axis=1)
+    padded_coarse = np.zeros(coarse_search + len(coarse) + coarse_frame + coarse_search, dtype=np.float32)
+    padded_coarse[coarse_search:coarse_search + len(coarse)] = coarse
+
+    # Periodic Hann windows half a frame apart add up to exactly one
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame) / frame)).astype(np.float32)
+    n_frames = int((len(audio) - frame) / (hop * tempo)) + 1
+    output = np.zeros(((n_frames - 1) * hop + frame, n_channels), dtype=np.float32)
+    weights = np.zeros(len(output), dtype=np.float32)
+
+    position = 0
+    for idx in range(n_frames):
+        if idx > 0:
+            # The input that naturally followed the previous frame is what this frame should sound like
+            follow = position + hop
+            nominal = int(round(idx * hop * tempo))
+
+            start = nominal // step
+            template = padded_coarse[follow // step + coarse_search:follow // step + coarse_search + coarse_frame]
+            region = padded_coarse[start:start + 2 * coarse_search + coarse_frame]
+            best = nominal + (_best_match(region, template) - coarse_search) * step
+
+            template = padded_mono[follow + margin:follow + margin + frame]
+            region = padded_mono[best - step + margin:best + step + margin + frame]
+            best += _best_match(region, template) - step
+
+            position = max(0, min(len(audio) - 1, best))
+
+        out = idx * hop
+        output[out:out + frame] += padded[position + margin:position + margin + frame] * window[:, None]
+        weights[out:out + frame] += window
+
+    length = min(len(output), int(round(len(audio) / tempo)))
+    weights = np.maximum(weights[:length], 1e-6)
+
+    return output[:length] / weights[:, None]
+
+
+def _best_match(region: np.ndarray, template: np.ndarray) -> int:
+    """
+    Returns the offset into region where the template lines up best, by normalized cross-correlation.
+    """
+    scores = np.correlate(region, template, mode="valid")
+    energy = np.cumsum(np.concatenate(([0.0], np.square(region, dtype=np.float64))))
+    scores = scores / np.sqrt(energy[len(template):] - energy[:-len(template)] + 1e-9)
+
+    return int(np.argmax(scores))
+
+
+def _db_to_power(dbfs: float) -> float:
+    return 10 ** (dbfs / 10)
@@ -0,0 +1,75 @@
+"""
+Moves a character's mouth along with what it is saying, by swapping between an idle and a talking source in OBS
+"""
+import numpy as np
+from .audioprocessing import ProcessedAudio
+from .obsmanager import OBSWSManager
+
+
+class LipSync:
+    """
+    Swaps between a character's idle and talking sources while a processed clip plays. Whether the mouth is open at
+    every point of the clip is worked out from its amplitude envelope before it starts playing, so during playback
+    only the swaps have to be sent to OBS, each as a single request batch.
+    """
+
+    def __init__(self, obs: OBSWSManager, scene_name: str, idle_source: str, talking_source: str,
+                 audio: ProcessedAudio, threshold_dbfs: float = -35.0, hold: float = 0.1) -> None:
+        """
+        :param obs: The OBS connection to send the swaps over.
+        :param scene_name: The scene both sources are in.
+        :param idle_source: The source shown while the character is quiet. Expected to be visible already.
+        :param talking_source: The source shown while the character is making a sound.
+        :param audio: The clip to move along with.
+        :param threshold_dbfs: Level in dBFS above which the mouth opens.
+        :param hold: Seconds the mouth stays open after the level drops, so it does not flicker between syllables.
+        """
+        self._obs = obs
+        self._scene_name = scene_name
+        self._idle_source = idle_source
+        self._talking_source = talking_source
+
+        self._states = mouth_states(audio.envelope, audio.envelope_rate, threshold_dbfs, hold)
+        self._rate = audio.envelope_rate
+        self._talking = False
+        self._failed = False
+
+    def update(self, elapsed: float) -> None:
+        """
+        Shows the source matching the clip after elapsed seconds of playback, if it is not shown already.
+        Errors are logged and stop further updates instead of interrupting playback.
+        """
+        if self._failed or len(self._states) == 0:
+            return
+
+        talking = bool(self._states[min(len(self._states) - 1, int(elapsed * self._rate))])
+        if talking != self._talking:
+            self._swap(talking)
+
+    def _swap(self, talking: bool) -> None:
+        # The source being swapped in is shown before the other one is hidden, so the character never disappears
+        shown, hidden = (self._talking_source, self._idle_source) if talking else (self._idle_source,
+                                                                                   self._talking_source)
+
+        try:
+            self._obs.set_sources_visibility(self._scene_name, {shown: True, hidden: False})
+        except Exception as e:
+            print(f"[LipSync] Could not swap to {shown}, leaving the mouth as it is: {e}")
+            self._failed = True
+            return
+
+        self._talking = talking
+
+
+def mouth_states(envelope: np.ndarray, envelope_rate: float, threshold_dbfs: float, hold: float) -> np.ndarray:
+    """
+    Returns whether the mouth is open for every value of an amplitude envelope. It opens where the level is above
+    threshold_dbfs and stays open for hold seconds after.
+    """
+    loud = envelope > 10 ** (threshold_dbfs / 20)
+    hold_values = int(round(hold * envelope_rate))
+    if hold_values == 0 or len(loud) == 0:
+        return loud
+
+    # Counts the loud values in a trailing window, which is above zero wherever the mouth was open recently
+    return np.convolve(loud, np.ones(hold_values + 1, dtype=np.int32))[:len(loud)] > 0
@@ -1,4 +1,10 @@
-import obsws_python as obs
+import json
+import itertools
+from src.telemetry import metrics
+
+# obs-websocket opcodes for sending several requests in one message and getting their results back
+REQUEST_BATCH_OP = 8
+REQUEST_BATCH_RESPONSE_OP = 9
 
 
 class OBSWSManager:
@@ -11,30 +17,103 @@ class OBSWSManager:
         :param password: The password to access websockets with.
         :param timeout: How long to wait in seconds until timing out the connection.
         """
+        # Imported here so the module can be loaded without paying for the websocket client
+        import obsws_python as obs
         self._obs = obs.ReqClient(host=host, port=port, password=password, timeout=timeout)
 
+        # Scene item IDs only change when a source is removed from a scene, so they are looked up once
+        self._item_ids: dict[tuple[str, str], int] = {}
+        self._batch_ids = itertools.count()
+
+    def disconnect(self) -> None:
+        """
+        Closes the websocket connection to OBS.
+        """
+        self._obs.disconnect()
+
     def get_scene_item_id(self, scene_name: str, source_name: str) -> int:
         """
         Gets the OBS Item ID from the scene and source name. Used as a preliminary step for using other methods that
-        typically require the item id.
+        typically require the item id. IDs are cached after the first lookup.
         """
-        response = self._obs.get_scene_item_id(scene_name, source_name)
+        item_id = self._item_ids.get((scene_name, source_name))
+        if item_id is not None:
+            return item_id
+
+        with metrics.OBS_REQUEST_SECONDS.time(request="GetSceneItemId"):
+            response = self._obs.get_scene_item_id(scene_name, source_name)
+
+        self._item_ids[(scene_name, source_name)] = response.scene_item_id
         return response.scene_item_id
 
     def set_source_visibility(self, scene_name: str, source_name: str, visible: bool = True) -> None:
         """
         Shows or hides a scene given its scene and source name.
         """
+        self.set_sources_visibility(scene_name, {source_name: visible})
 
-        source_id: int = self.get_scene_item_id(scene_name, source_name)
-        self._obs.set_scene_item_enabled(scene_name, source_id, visible)
+    def set_sources_visibility(self, scene_name: str, visibility: dict[str, bool]) -> None:
+        """
+        Shows or hides several sources of a scene in a single request batch, in the order given. Used to swap one
+        source for another without OBS rendering a frame in between.
+
+        :param scene_name: The scene the sources are in.
+        :param visibility: Whether to show each source, keyed by source name.
+        """
+        try:
+            self._set_sources_visibility(scene_name, visibility)
+        except Exception:
+            # A source may have been removed and added back in OBS, giving it a new ID
+            for source_name in visibility:
+                self._item_ids.pop((scene_name, source_name), None)
+
+            self._set_sources_visibility(scene_name, visibility)
+
+    def _set_sources_visibility(self, scene_name: str, visibility: dict[str, bool]) -> None:
+        items = [(self.get_scene_item_id(scene_name, source_name), visible)
+                 for source_name, visible in visibility.items()]
+
+        if len(items) == 1:
+            with metrics.OBS_REQUEST_SECONDS.time(request="SetSceneItemEnabled"):
+                self._obs.set_scene_item_enabled(scene_name, *items[0])
+            return
+
+        requests = [{"requestType": "SetSceneItemEnabled",
+                     "requestData": {"sceneName": scene_name, "sceneItemId": item_id, "sceneItemEnabled": visible}}
+                    for item_id, visible in items]
+
+        with metrics.OBS_REQUEST_SECONDS.time(request="RequestBatch"):
+            results = self._send_batch(requests)
+
+        failed = [result for result in results if not result["requestStatus"]["result"]]
+        if failed:
+            raise RuntimeError(f"OBS could not change the visibility of a source: {failed[0]['requestStatus']}")
+
+    def _send_batch(self, requests: list[dict]) -> list[dict]:
+        """
+        Sends a request batch, returning the result of each request. obsws_python has no support for batches, so
+        they are sent over its websocket directly.
+        """
+        payload = {"op": REQUEST_BATCH_OP,
+                   "d": {"requestId": f"batch-{next(self._batch_ids)}", "haltOnFailure": False,
+                         "executionType": 0, "requests": requests}}
+
+        websocket = self._obs.base_client.ws
+        websocket.send(json.dumps(payload))
+
+        response = json.loads(websocket.recv())
+        if response["op"] != REQUEST_BATCH_RESPONSE_OP:
+            raise RuntimeError(f"Expected a request batch response from OBS, got opcode {response['op']}")
+
+        return response["d"]["results"]
 
     def get_source_visibility(self, scene_name: str, source_name: str) -> bool:
         """
         Gets whether a source given its scene and source name is visible or not.
         """
         source_id: int = self.get_scene_item_id(scene_name, source_name)
-        return self._obs.get_scene_item_enabled(scene_name, source_id).scene_item_enabled
+        with metrics.OBS_REQUEST_SECONDS.time(request="GetSceneItemEnabled"):
+            return self._obs.get_scene_item_enabled(scene_name, source_id).scene_item_enabled
 
 
 if __name__ == "__main__":
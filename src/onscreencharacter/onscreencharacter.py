@@ -1,88 +1,290 @@
 import os
-import dotenv
+import copy
 import time
-from typing import Optional
+import asyncio
+from typing import Optional, Callable, TYPE_CHECKING
 
-from gtts import gTTS
-from src.llm import RemoteLLMManager
+from src.config import Config, get_config
+from src.llm import BaseLLM, create_llm_manager
+from src.telemetry import metrics
 from .audiomanager import AudioManager
 from .obsmanager import OBSWSManager
 
+if TYPE_CHECKING:
+    from .audioprocessing import ProcessedAudio
+
 
 class OnScreenCharacter:
-    def __init__(self, scene_name: str, source_name: str):
+    def __init__(self, scene_name: str, source_name: str, config: Optional[Config] = None,
+                 voice: Optional[str] = None, message_history: Optional[list[dict[str, str]]] = None,
+                 talking_source: Optional[str] = None):
+        """
+        :param scene_name: The OBS scene the character is in.
+        :param source_name: The OBS source showing the character.
+        :param config: Settings to use instead of the ones from the environment.
+        :param voice: The gTTS language to speak in, optionally followed by the Google domain picking the accent.
+                      For example en or en:co.uk. Defaults to en.
+        :param message_history: Conversation to continue once the LLM is connected.
+        :param talking_source: An OBS source in the same scene showing the character with its mouth open. If given,
+                               it is swapped in for source_name whenever the character makes a sound.
+        """
         self._scene_name = scene_name
         self._source_name = source_name
+        self._talking_source = talking_source
+        self._config: Config = config if config is not None else get_config()
+        self.verbose: bool = self._config.verbose
+
+        lang, _, tld = (voice or "en").partition(":")
+        self._tts_lang: str = lang
+        self._tts_tld: str = tld or "com"
+        self._message_history = message_history
+
+        # Connecting to the LLM API, the audio device and OBS is slow, so it is left to warm_up
+        self._llm: Optional[BaseLLM] = None
+        self._audio: Optional[AudioManager] = None
+        self._obs: Optional[OBSWSManager] = None
+        self._warm_up_lock = asyncio.Lock()
+
+        # Guards the conversation history. Held while the LLM is answering so API edits cannot interleave with it,
+        # but released before TTS and playback so edits never wait on audio.
+        self._lock = asyncio.Lock()
+
+    @property
+    def model_name(self) -> str:
+        """
+        Name of the model that answered last, or the configured model before the LLM is connected.
+        """
+        if self._llm is not None:
+            return self._llm.model_name
+
+        return self._config.llm_model
+
+    @property
+    def ready(self) -> bool:
+        """
+        Whether the character has connected to everything it needs to talk.
+        """
+        return self._llm is not None and self._audio is not None and self._obs is not None
+
+    async def warm_up(self) -> None:
+        """
+        Connects to the LLM API, the audio device and OBS if that has not been done yet. talk waits for this, so
+        calling it ahead of time keeps the first prompt from paying for it.
+        """
+        async with self._warm_up_lock:
+            if not self.ready:
+                await asyncio.to_thread(self._connect)
+
+    async def _warm_up_llm(self) -> None:
+        # Editing the conversation only needs the LLM, so it keeps working while OBS is unreachable
+        async with self._warm_up_lock:
+            if self._llm is None:
+                await asyncio.to_thread(self._connect_llm)
+
+    def _connect(self) -> None:
+        # Anything that connected before a failure is kept, so a retry only redoes what is missing
+        config = self._config
+
+        if self._llm is None:
+            self._connect_llm()
+
+        if self._audio is None:
+            processor = None
+            if config.audio_processing:
+                # Imported here as loading NumPy is slow
+                from .audioprocessing import AudioProcessor
+                processor = AudioProcessor.from_config(config)
+
+            self._audio = AudioManager(self.verbose, processor)
+
+        if self._obs is None:
+            self._obs = OBSWSManager(config.obs_host, config.obs_port, config.obs_password)
+
+        self._log(f"Connected to {config.llm_model} and OBS.")
+
+    def _connect_llm(self) -> None:
+        # Counts the tokens of the system message, which takes a round-trip to the API
+        llm = create_llm_manager(self._config)
+
+        if self._message_history:
+            llm.set_message_history(self._message_history)
+
+        # Set before the pending history is dropped, so get_message_history always sees one of them
+        self._llm = llm
+        self._message_history = None
+
+    async def close(self) -> Optional[list[dict[str, str]]]:
+        """
+        Disconnects from OBS and lets go of the LLM. Must not be called while the character is talking.
+        Returns the conversation history so another character can continue it, or None if there is none.
+        """
+        async with self._warm_up_lock:
+            llm, obs = self._llm, self._obs
+            self._llm = self._audio = self._obs = None
 
-        dotenv.load_dotenv(dotenv.find_dotenv())
+            # Taken first, so the conversation is not lost if disconnecting fails
+            if llm is not None:
+                self._message_history = llm.get_message_history()
 
-        # Variables to connect to LLM API
-        llm_model: str = str(os.getenv("AI_LLM_MODEL"))
-        api_key: str = str(os.getenv("AI_API_KEY"))
-        api_url: str = str(os.getenv("AI_API_URL"))
-        system_message: Optional[str] = os.getenv("AI_SYSTEM_MESSAGE")
-        self.verbose: bool = bool(os.getenv("AI_VERBOSE"))
-        n_ctx: int = int(os.getenv("AI_n_ctx"))
+        if obs is not None:
+            try:
+                await asyncio.to_thread(obs.disconnect)
+            except Exception as e:
+                print(f"[CharacterMgr] Could not cleanly disconnect from OBS: {e}")
 
-        # Variables to connect to OBS WS
-        obs_host: str = str(os.getenv("OBSWS_HOST"))
-        obs_port: int = int(os.getenv("OBSWS_PORT"))
-        obs_password: str = str(os.getenv("OBSWS_PASSWORD"))
+        return self._message_history
 
-        self._llm: RemoteLLMManager = RemoteLLMManager(llm_model, api_key, api_url,
-                                                       system_message=system_message, verbose=self.verbose, n_ctx=n_ctx)
-        self._audio = AudioManager(self.verbose)
-        self._obs = OBSWSManager(obs_host, obs_port, obs_password)
+    async def talk(self, msg: str, on_stage: Optional[Callable[..., None]] = None) -> tuple[str, dict[str, int]]:
+        """
+        Has the character answer a message out loud, returning the response in the following format
+        (response, token_usage_info).
+
+        :param msg: The message to respond to.
+        :param on_stage: Called as on_stage(stage, text=None) when entering the generating, synthesizing and playing
+                         stages. The response text is given along with the synthesizing stage.
+        """
+        if on_stage is None:
+            on_stage = _ignore_stage
+
+        on_stage("generating")
+        response = await self.ask(msg)
 
-    def talk(self, msg: str):
-        # Ask the LLM
-        response = self._llm.ask(msg)
+        on_stage("synthesizing", text=response[0])
+        await self.speak(response[0], on_stage)
+
+        return response
+
+    async def ask(self, msg: str) -> tuple[str, dict[str, int]]:
+        """
+        Has the LLM answer a message without speaking, returning the response in the following format
+        (response, token_usage_info). The conversation history is left as it was if the LLM fails.
+        """
+        await self.warm_up()
+
+        async with self._lock:
+            history = self._llm.get_message_history()
+            try:
+                response = await self._llm.ask_async(msg)
+            except BaseException:
+                # Otherwise a retry would leave the message in the history twice
+                self._llm.restore_message_history(history)
+                raise
 
-        # Print out its response
         self._log(f"Got this response: {response[0]}")
         self._log(f"Token Information: {response[1]}")
 
+        return response
+
+    async def speak(self, text: str, on_stage: Optional[Callable[..., None]] = None) -> None:
+        """
+        Shows the character and reads out text, for example an answer from ask. Raises if the speech could not be
+        synthesized or played.
+
+        :param text: What to say.
+        :param on_stage: Called as on_stage("playing") once the audio starts.
+        """
+        if on_stage is None:
+            on_stage = _ignore_stage
+
+        await self.warm_up()
+
+        # Create text to speech reading out the response. Errors are raised so the job can be retried.
         file_name = f"tts_temp_{time.time()}.mp3"
-        try:
-            # Create text to speech reading out the response
-            tts = gTTS(response[0], lang="en")
-            tts.save(file_name)
-        except Exception as e:
-            print(f"[CharacterMgr] Ran into an error while generating TTS: {e}")
-            print(f"[CharacterMgr] Please manually generate audio file named recover.mp3 and press enter to continue.")
+        await asyncio.to_thread(self._synthesize, text, file_name)
 
-            file_name = "recover.mp3"
-            input()
+        # Decode, trim, speed up and level the speech before the character is shown
+        audio = await asyncio.to_thread(self._audio.prepare, file_name)
 
-        # Show character in OBS and play audio
-        self._obs.set_source_visibility(self._scene_name, self._source_name, True)
-        self._audio.play(file_name)
-        self._obs.set_source_visibility(self._scene_name, self._source_name, False)
+        # Show character in OBS and play audio. These are blocking clients so they run off the event loop.
+        on_stage("playing")
+        await asyncio.to_thread(self._obs.set_source_visibility, self._scene_name, self._source_name, True)
+        if audio is not None:
+            await asyncio.to_thread(self._play_lip_synced, audio)
+        else:
+            await asyncio.to_thread(self._audio.play, file_name)
 
-    def get_message_history(self) -> list[dict[str, str]]:
+        hidden = {self._source_name: False}
+        if self._talking_source is not None:
+            hidden[self._talking_source] = False
+        await asyncio.to_thread(self._obs.set_sources_visibility, self._scene_name, hidden)
+
+    def _play_lip_synced(self, audio: "ProcessedAudio") -> None:
+        """
+        Plays a processed clip, swapping to the talking source while the character makes a sound if it has one.
+        Both sources are left for talk to hide.
+        """
+        if self._talking_source is None:
+            self._audio.play_audio(audio)
+            return
+
+        # Processed audio means NumPy is loaded already
+        from .lipsync import LipSync
+
+        config = self._config
+        lip_sync = LipSync(self._obs, self._scene_name, self._source_name, self._talking_source, audio,
+                           config.lip_sync_threshold_dbfs)
+        self._audio.play_audio(audio, lip_sync.update, 1 / config.lip_sync_rate)
+
+    def _synthesize(self, text: str, file_name: str) -> None:
+        """
+        Creates text to speech reading out the text and saves it into file_name.
         """
-        Returns a copy of the messages in the conversation history.
+        # gTTS pulls in requests and friends, so it is only imported once there is something to say
+        from gtts import gTTS
+
+        with metrics.TTS_SECONDS.time():
+            tts = gTTS(text, lang=self._tts_lang, tld=self._tts_tld)
+            try:
+                tts.save(file_name)
+            except Exception:
+                # A partly written file would never be played or cleaned up
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+                raise
+
+    async def get_message_history(self) -> list[dict[str, str]]:
         """
-        return self._llm.get_message_history()
+        Returns a copy of the messages in the conversation history. Reading it never connects the LLM, so it works
+        while the LLM API is down.
+        """
+        async with self._lock:
+            if self._llm is not None:
+                return self._llm.get_message_history()
+
+            # The history the LLM starts with once it connects
+            messages = copy.deepcopy(self._message_history or [])
+            system_message = self._config.system_message
+            if system_message is not None and (len(messages) == 0 or messages[0]["role"] != "system"):
+                messages.insert(0, {"role": "system", "content": system_message})
 
-    def set_message_history(self, messages: list[dict[str, str]] | None = None) -> None:
+            return messages
+
+    async def set_message_history(self, messages: list[dict[str, str]] | None = None) -> None:
         """
         Sets the message history of the LLM to the given history
         """
-        return self._llm.set_message_history(messages)
+        await self._warm_up_llm()
+        async with self._lock:
+            return await self._llm.set_message_history_async(messages)
 
-    def set_system_message(self, system_message: str | None = None) -> int:
+    async def set_system_message(self, system_message: str | None = None) -> int:
         """
         Sets a new system message, returning the number of tokens present
         """
-        return self._llm.set_system_message(system_message)
+        await self._warm_up_llm()
+        async with self._lock:
+            return await self._llm.set_system_message_async(system_message)
 
     def _log(self, *args):
         if self.verbose:
             print("[CharacterMgr]", *args)
 
 
+def _ignore_stage(stage: str, text: Optional[str] = None) -> None:
+    pass
+
+
 if __name__ == "__main__":
     # Testing OnScreenCharacter
     my_char = OnScreenCharacter("Websockets Testing", "Steve - AICharacter")
-    my_char.talk("Who are you")
+    asyncio.run(my_char.talk("Who are you"))
@@ -0,0 +1,6 @@
+__all__ = ["Job", "JobStatus", "JobTracker", "JobQueue", "DurableJobQueue", "CharacterRegistry", "CharacterSpec",
+           "UnknownCharacter"]
+
+from .jobs import Job, JobStatus, JobTracker, JobQueue
+from .durable_queue import DurableJobQueue
+from .registry import CharacterRegistry, CharacterSpec, UnknownCharacter
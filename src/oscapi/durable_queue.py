@@ -0,0 +1,176 @@
+import time
+import asyncio
+import sqlite3
+from typing import Optional
+from .jobs import Job, JobStatus, JobQueue, JobTracker
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    character TEXT NOT NULL,
+    message TEXT NOT NULL,
+    submitter TEXT,
+    priority INTEGER NOT NULL,
+    queued_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    failed_at REAL
+)
+"""
+
+
+class DurableJobQueue(JobQueue):
+    """
+    A JobQueue that also writes every job to an SQLite database until it has been played, so jobs survive the API
+    crashing or restarting. Jobs still in the database are queued again on startup by recover.
+
+    Jobs that fail are retried after a delay, up to max_attempts times, and then moved to the dead letters where
+    they can be looked at and retried by hand. A job counts as attempted as soon as it is taken off the queue, so
+    one that keeps crashing the whole process ends up in the dead letters too.
+
+    The database runs in WAL mode without syncing every commit, which survives the process crashing (but not the
+    machine losing power) and keeps queueing a job down to a fraction of a millisecond.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3, retry_delay: float = 5.0) -> None:
+        """
+        :param path: The SQLite database file. Created if it does not exist.
+        :param max_attempts: How many times a job is tried before it is moved to the dead letters.
+        :param retry_delay: Seconds to wait before retrying a job, multiplied by the attempts made so far.
+        """
+        super().__init__()
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._retries: dict[str, asyncio.TimerHandle] = {}
+
+        # Only ever used from the event loop
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+
+    def put(self, job: Job) -> None:
+        self._insert([job])
+        self._push(job)
+
+    def put_many(self, jobs: list[Job]) -> None:
+        """
+        Queues several jobs at once, writing them in a single transaction. Nothing else can be queued in between,
+        as this never gives up the event loop.
+        """
+        self._insert(jobs)
+        for job in jobs:
+            self._push(job)
+
+    async def get(self) -> Job:
+        """
+        Waits for the next job and takes it off the queue, counting it as an attempt.
+        """
+        job = await super().get()
+
+        job.attempts += 1
+        self._db.execute("UPDATE jobs SET attempts = ? WHERE id = ?", (job.attempts, job.id))
+        return job
+
+    def ack(self, job: Job) -> None:
+        """
+        Removes a job from the database once it has been played.
+        """
+        self._db.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+    def nack(self, job: Job, error: str, retry: bool = True) -> bool:
+        """
+        Queues a failed job again after a delay, or moves it to the dead letters once it has used up its attempts or
+        retry is False. Returns whether it will be retried.
+        """
+        if not retry or job.attempts >= self._max_attempts:
+            self._db.execute("UPDATE jobs SET dead = 1, error = ?, failed_at = ? WHERE id = ?",
+                             (error, time.time(), job.id))
+            return False
+
+        self._db.execute("UPDATE jobs SET error = ? WHERE id = ?", (error, job.id))
+
+        # Held back off the heap until the delay is over, and recovered from the database if the API stops first
+        loop = asyncio.get_running_loop()
+        self._retries[job.id] = loop.call_later(self._retry_delay * job.attempts, self._retry, job)
+        return True
+
+    def recover(self, tracker: JobTracker) -> list[Job]:
+        """
+        Queues the jobs left in the database by a previous run, in the order they were first queued, and adds them
+        to the tracker. Jobs that have used up their attempts are moved to the dead letters instead.
+        """
+        self._db.execute("UPDATE jobs SET dead = 1, error = ?, failed_at = ? WHERE dead = 0 AND attempts >= ?",
+                         ("Used up its attempts before the API restarted.", time.time(), self._max_attempts))
+
+        rows = self._db.execute("SELECT id, character, message, submitter, priority, queued_at, attempts FROM jobs "
+                                "WHERE dead = 0 ORDER BY seq").fetchall()
+
+        jobs = []
+        for job_id, character, message, submitter, priority, queued_at, attempts in rows:
+            job = Job(character, message, submitter, priority, job_id=job_id, queued_at=queued_at, attempts=attempts)
+            tracker.add(job)
+            self._push(job)
+            jobs.append(job)
+
+        return jobs
+
+    def get_dead_letters(self, limit: int = 100) -> list[dict]:
+        """
+        Returns the jobs that failed for good, most recent first.
+        """
+        rows = self._db.execute("SELECT id, character, message, submitter, priority, attempts, error, failed_at "
+                                "FROM jobs WHERE dead = 1 ORDER BY failed_at DESC LIMIT ?", (limit,)).fetchall()
+
+        return [{"id": job_id, "character": character, "message": message, "submitter": submitter,
+                 "priority": priority, "attempts": attempts, "error": error, "failed_at": failed_at}
+                for job_id, character, message, submitter, priority, attempts, error, failed_at in rows]
+
+    def retry_dead_letter(self, job_id: str, tracker: JobTracker) -> Optional[Job]:
+        """
+        Queues a dead letter again with its attempts reset, tracking it as a fresh job with the same ID.
+        Returns None if there is no such dead letter.
+        """
+        row = self._db.execute("SELECT character, message, submitter, priority FROM jobs WHERE id = ? AND dead = 1",
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        self._db.execute("UPDATE jobs SET dead = 0, attempts = 0, error = NULL, failed_at = NULL WHERE id = ?",
+                         (job_id,))
+
+        job = Job(*row, job_id=job_id)
+        tracker.add(job)
+        self._push(job)
+
+        return job
+
+    def close(self) -> None:
+        """
+        Stops pending retries and closes the database. Jobs still in it are recovered on the next start.
+        """
+        for handle in self._retries.values():
+            handle.cancel()
+
+        self._retries.clear()
+        self._db.close()
+
+    def _insert(self, jobs: list[Job]) -> None:
+        rows = [(job.id, job.character, job.message, job.submitter, job.priority,
+                 job.timestamps[JobStatus.QUEUED.value], job.attempts) for job in jobs]
+
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany("INSERT INTO jobs (id, character, message, submitter, priority, queued_at, "
+                                 "attempts) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        self._db.execute("COMMIT")
+
+    def _retry(self, job: Job) -> None:
+        del self._retries[job.id]
+        self._push(job)
@@ -0,0 +1,271 @@
+import time
+import uuid
+import heapq
+import asyncio
+import itertools
+from enum import Enum
+from typing import Optional, AsyncIterator, Callable
+from collections import OrderedDict, Counter
+
+
+class JobStatus(str, Enum):
+    """
+    The stages a queued character prompt moves through, in order. DONE and FAILED are terminal.
+    """
+    QUEUED = "queued"
+    GENERATING = "generating"
+    SYNTHESIZING = "synthesizing"
+    PLAYING = "playing"
+    DONE = "done"
+    FAILED = "failed"
+
+
+TERMINAL_STATUSES = (JobStatus.DONE, JobStatus.FAILED)
+
+
+class Job:
+    """
+    A single prompt queued for an onscreen character. Records when each stage was entered and pushes every
+    state transition to its subscribers.
+    """
+
+    def __init__(self, character: str, message: str, submitter: Optional[str] = None, priority: int = 0,
+                 job_id: Optional[str] = None, queued_at: Optional[float] = None, attempts: int = 0) -> None:
+        """
+        :param job_id: ID of a job being restored, for example after a restart. New jobs are given a random one.
+        :param queued_at: Wall clock time a restored job was first queued at.
+        :param attempts: How many times a restored job has been worked on before.
+        """
+        self.id: str = job_id if job_id is not None else uuid.uuid4().hex
+        self.character: str = character
+        self.message: str = message
+        self.submitter: Optional[str] = submitter
+        self.priority: int = priority
+        self.attempts: int = attempts
+        self.status: JobStatus = JobStatus.QUEUED
+        self.text: Optional[str] = None
+        self.error: Optional[str] = None
+
+        # Wall clock time each stage was entered at
+        self.timestamps: dict[str, float] = {JobStatus.QUEUED.value: queued_at if queued_at is not None
+                                             else time.time()}
+        self._subscribers: set[asyncio.Queue] = set()
+
+        # Called once the job finishes, by the tracker to know when it can be forgotten
+        self._on_finished: Optional[Callable[["Job"], None]] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def set_status(self, status: JobStatus | str, text: Optional[str] = None, error: Optional[str] = None) -> None:
+        """
+        Moves the job into a new stage and notifies everyone listening. Must be called from the event loop.
+        """
+        self.status = JobStatus(status)
+        self.timestamps[self.status.value] = time.time()
+
+        if text is not None:
+            self.text = text
+        if error is not None:
+            self.error = error
+
+        self._notify()
+
+        if self.finished and self._on_finished is not None:
+            self._on_finished(self)
+
+    def requeue(self, error: str) -> None:
+        """
+        Puts the job back in the queued state to be tried again, keeping the error of the failed attempt and the
+        text generated for it, so a retry does not ask the LLM again. Must be called from the event loop.
+        """
+        self.status = JobStatus.QUEUED
+        self.timestamps = {JobStatus.QUEUED.value: time.time()}
+        self.error = error
+
+        self._notify()
+
+    def _notify(self) -> None:
+        event = self.to_dict()
+        for subscriber in self._subscribers:
+            subscriber.put_nowait(event)
+
+    def get_stage_durations(self) -> dict[str, float]:
+        """
+        Returns how many seconds were spent in each stage that has been left so far.
+        """
+        durations = {}
+        stages = list(self.timestamps.items())
+
+        for (stage, started), (_, ended) in zip(stages, stages[1:]):
+            durations[stage] = ended - started
+
+        return durations
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "character": self.character,
+            "submitter": self.submitter,
+            "priority": self.priority,
+            "attempts": self.attempts,
+            "status": self.status.value,
+            "text": self.text,
+            "error": self.error,
+            "timestamps": dict(self.timestamps),
+            "durations": self.get_stage_durations()
+        }
+
+    async def events(self) -> AsyncIterator[dict]:
+        """
+        Yields the current state of the job followed by every state transition until the job finishes.
+        """
+        subscriber: asyncio.Queue = asyncio.Queue()
+        self._subscribers.add(subscriber)
+
+        try:
+            event = self.to_dict()
+            yield event
+
+            while event["status"] not in TERMINAL_STATUSES:
+                event = await subscriber.get()
+                yield event
+        finally:
+            self._subscribers.discard(subscriber)
+
+
+class JobTracker:
+    """
+    Keeps track of every job that is queued or running and a bounded number of finished jobs for status lookups.
+    """
+
+    def __init__(self, max_finished: int = 1000) -> None:
+        """
+        :param max_finished: How many finished jobs to remember before the oldest ones are forgotten.
+        """
+        self._jobs: dict[str, Job] = {}
+        self._max_finished = max_finished
+
+        # IDs of the finished jobs still remembered, in the order they finished
+        self._finished: OrderedDict[str, None] = OrderedDict()
+
+    def create(self, character: str, message: str, submitter: Optional[str] = None, priority: int = 0) -> Job:
+        """
+        Creates and tracks a new job in the queued state.
+        """
+        job = Job(character, message, submitter, priority)
+        self.add(job)
+
+        return job
+
+    def add(self, job: Job) -> None:
+        """
+        Tracks an existing job, for example one restored from a durable queue.
+        """
+        # A job tracked again under the same ID, like a retried dead letter, is not finished anymore
+        self._finished.pop(job.id, None)
+
+        job._on_finished = self._job_finished
+        self._jobs[job.id] = job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def _job_finished(self, job: Job) -> None:
+        """
+        Remembers that a job finished, forgetting the one that finished longest ago once we remember more than
+        max_finished of them.
+        """
+        if self._jobs.get(job.id) is not job:
+            return
+
+        self._finished[job.id] = None
+        self._finished.move_to_end(job.id)
+
+        while len(self._finished) > self._max_finished:
+            job_id, _ = self._finished.popitem(last=False)
+            del self._jobs[job_id]
+
+
+class JobQueue:
+    """
+    Jobs waiting for the worker. Higher priority jobs are handed out first, and jobs of the same priority in the
+    order they were queued.
+    """
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[int, int, Job]] = []
+        self._counter = itertools.count()
+        self._available = asyncio.Semaphore(0)
+
+        # Jobs of the same priority leave in the order they came in, so counting how many of each priority were
+        # pushed and taken, and the order each queued job came in within its priority, is enough to place it
+        self._pushed: Counter[int] = Counter()
+        self._taken: Counter[int] = Counter()
+        self._order: dict[str, int] = {}
+
+    def put(self, job: Job) -> None:
+        self._push(job)
+
+    def put_many(self, jobs: list[Job]) -> None:
+        """
+        Queues several jobs at once. Nothing else can be queued in between, as this never gives up the event loop.
+        """
+        for job in jobs:
+            self.put(job)
+
+    async def get(self) -> Job:
+        """
+        Waits for the next job and takes it off the queue.
+        """
+        await self._available.acquire()
+        job = heapq.heappop(self._heap)[2]
+
+        del self._order[job.id]
+        self._taken[job.priority] += 1
+        if self._taken[job.priority] == self._pushed[job.priority]:
+            del self._taken[job.priority], self._pushed[job.priority]
+
+        return job
+
+    def ack(self, job: Job) -> None:
+        """
+        Marks a job taken off the queue as handled, once it has been played.
+        """
+
+    def nack(self, job: Job, error: str, retry: bool = True) -> bool:
+        """
+        Reports that working on a job taken off the queue failed. Returns whether it was queued again to be retried,
+        which this queue never does, as it forgets jobs once they are taken off.
+        """
+        return False
+
+    def close(self) -> None:
+        """
+        Lets go of anything the queue holds on to once the worker has stopped.
+        """
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+    def position(self, job: Job) -> int:
+        """
+        Returns where a job is in line, starting from 1, or 0 if it is not queued. Only looks at the priorities
+        in the queue, not every job.
+        """
+        order = self._order.get(job.id)
+        if order is None:
+            return 0
+
+        ahead = sum(pushed - self._taken[priority] for priority, pushed in self._pushed.items()
+                    if priority > job.priority)
+
+        return 1 + ahead + order - self._taken[job.priority]
+
+    def _push(self, job: Job) -> None:
+        self._order[job.id] = self._pushed[job.priority]
+        self._pushed[job.priority] += 1
+
+        heapq.heappush(self._heap, (-job.priority, next(self._counter), job))
+        self._available.release()
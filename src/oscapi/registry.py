@@ -0,0 +1,291 @@
+import os
+import csv
+import time
+import asyncio
+import dataclasses
+from dataclasses import dataclass
+from typing import Optional, Callable, AsyncIterator
+from contextlib import asynccontextmanager
+from onscreencharacter import OnScreenCharacter
+from src.config import Config
+
+REQUIRED_COLUMNS = ("character_name", "scene_name", "source_name")
+OPTIONAL_COLUMNS = ("model", "voice", "system_message", "talking_source")
+
+
+class UnknownCharacter(Exception):
+    """
+    Raised when a character is not in the registry, for example because it was removed from the file.
+    """
+
+
+@dataclass(frozen=True)
+class CharacterSpec:
+    """
+    One row of the characters file. The optional fields fall back to the settings from the environment.
+    """
+    name: str
+    scene_name: str
+    source_name: str
+    model: Optional[str] = None
+    voice: Optional[str] = None
+    system_message: Optional[str] = None
+    talking_source: Optional[str] = None
+
+    def apply_to(self, config: Config) -> Config:
+        """
+        Returns the settings with this character's model and system message in place of the defaults.
+        """
+        return dataclasses.replace(
+            config,
+            llm_model=self.model if self.model is not None else config.llm_model,
+            system_message=self.system_message if self.system_message is not None else config.system_message
+        )
+
+
+def load_character_specs(filepath: str) -> dict[str, CharacterSpec]:
+    """
+    Reads the characters file, keyed by lowercase character name. Raises a ValueError if the file is malformed.
+    """
+    specs = {}
+
+    with open(filepath, newline="", encoding="utf-8") as char_csv:
+        reader = csv.DictReader(char_csv, delimiter=",")
+
+        missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"{filepath} is missing the columns {', '.join(missing)}")
+
+        for row in reader:
+            name = row["character_name"].strip().lower()
+            if name in specs:
+                raise ValueError(f"{filepath} lists {name} more than once")
+
+            # Empty optional fields use the defaults
+            options = {column: row[column] for column in OPTIONAL_COLUMNS if row.get(column)}
+            specs[name] = CharacterSpec(name, row["scene_name"], row["source_name"], **options)
+
+    return specs
+
+
+class _Entry:
+    """
+    A registered character and, once it has been used, the live OnScreenCharacter for it.
+    """
+
+    def __init__(self, spec: CharacterSpec) -> None:
+        self.spec = spec
+        self.character: Optional[OnScreenCharacter] = None
+
+        # Conversation saved when the character was last torn down, handed to the next instance
+        self.history: Optional[list[dict[str, str]]] = None
+
+        self.in_use: int = 0
+        self.last_used: float = time.monotonic()
+
+        # Set once the spec changed while the character was live, so it is rebuilt as soon as it is idle
+        self.stale: bool = False
+        self.removed: bool = False
+
+        # Held while the character is created or torn down, never while it is used
+        self.lock = asyncio.Lock()
+
+
+class CharacterRegistry:
+    """
+    Keeps track of the characters listed in the characters file, picking up changes to it while the API is running.
+    Characters are only created once they are first used and are torn down again after sitting idle, keeping their
+    conversation for when they are next needed. A character whose row changed or was removed is only replaced once
+    nothing is using it, so a response that is being played is never cut off.
+    """
+
+    def __init__(self, filepath: str, config: Config, idle_timeout: float = 600.0, poll_interval: float = 2.0,
+                 factory: Callable[..., OnScreenCharacter] = OnScreenCharacter) -> None:
+        """
+        :param filepath: The characters CSV file.
+        :param config: The default settings of every character.
+        :param idle_timeout: Seconds a character may go unused before it is torn down. Set to 0 to keep them.
+        :param poll_interval: How often in seconds the file is checked for changes and idle characters are reaped.
+        :param factory: Creates characters, called like OnScreenCharacter.
+        """
+        self._filepath = filepath
+        self._config = config
+        self._idle_timeout = idle_timeout
+        self._poll_interval = poll_interval
+        self._factory = factory
+
+        self._entries: dict[str, _Entry] = {}
+        self._mtime: Optional[float] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._entries.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def load(self) -> None:
+        """
+        Reads the characters file and applies any changes. Raises if the file can not be read, keeping the current
+        characters.
+        """
+        # Recorded first so a broken file is only reported once, not on every poll until it is fixed
+        self._mtime = os.stat(self._filepath).st_mtime
+        specs = load_character_specs(self._filepath)
+
+        for name, entry in list(self._entries.items()):
+            spec = specs.get(name)
+
+            if spec is None:
+                del self._entries[name]
+                entry.removed = True
+                self._log(f"Removed {name}.")
+                self._retire_when_idle(entry)
+            elif spec != entry.spec:
+                entry.spec = spec
+                entry.stale = entry.character is not None
+                self._log(f"Updated {name}.")
+                self._retire_when_idle(entry)
+
+        for name, spec in specs.items():
+            if name not in self._entries:
+                self._entries[name] = _Entry(spec)
+                self._log(f"Added {name}.")
+
+    async def start(self) -> None:
+        """
+        Starts watching the file for changes and tearing down idle characters.
+        """
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        """
+        Stops watching the file and tears down every character that is not in use.
+        """
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+        for entry in list(self._entries.values()):
+            if entry.character is not None and entry.in_use == 0:
+                await self._teardown(entry)
+
+    @asynccontextmanager
+    async def use(self, name: str) -> AsyncIterator[OnScreenCharacter]:
+        """
+        Gives access to a character, creating it if needed. It is not torn down or replaced until the block exits.
+        Raises UnknownCharacter if the character is not registered.
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            raise UnknownCharacter(f"Character {name} does not exist.")
+
+        async with entry.lock:
+            if entry.stale and entry.in_use == 0:
+                await self._teardown(entry)
+
+            if entry.character is None:
+                entry.character = self._create(entry)
+
+            character = entry.character
+            entry.in_use += 1
+
+        try:
+            yield character
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            self._retire_when_idle(entry)
+
+    def warm_up(self, name: str) -> None:
+        """
+        Starts connecting a character in the background, so it is ready by the time its job is worked on.
+        """
+        task = asyncio.create_task(self._warm_up(name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _warm_up(self, name: str) -> None:
+        try:
+            async with self.use(name) as character:
+                await character.warm_up()
+        except Exception as e:
+            # Talking retries the connection and reports the error on the job
+            self._log(f"Could not warm up {name}: {e}")
+
+    def _create(self, entry: _Entry) -> OnScreenCharacter:
+        spec = entry.spec
+        history, entry.history = entry.history, None
+
+        self._log(f"Creating {spec.name}.")
+        return self._factory(spec.scene_name, spec.source_name, spec.apply_to(self._config), voice=spec.voice,
+                             message_history=history, talking_source=spec.talking_source)
+
+    async def _teardown(self, entry: _Entry) -> None:
+        """
+        Tears down the live character of an entry, saving its conversation. Must only be called while it is idle.
+        """
+        character, entry.character = entry.character, None
+        stale, entry.stale = entry.stale, False
+
+        try:
+            history = await character.close()
+        except Exception as e:
+            self._log(f"Could not cleanly tear down {entry.spec.name}: {e}")
+            return
+
+        if entry.removed or not history:
+            return
+
+        # A changed row may have a new system message, so only the rest of the conversation carries over then
+        if stale:
+            history = [message for message in history if message["role"] != "system"]
+
+        entry.history = history or None
+        self._log(f"Tore down {entry.spec.name}, keeping {len(history)} messages.")
+
+    def _retire_when_idle(self, entry: _Entry) -> None:
+        """
+        Tears down a character that was changed or removed, unless it is still in use, in which case this is done
+        once the last user is finished with it.
+        """
+        if entry.character is not None and (entry.stale or entry.removed) and entry.in_use == 0:
+            task = asyncio.create_task(self._retire(entry))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _retire(self, entry: _Entry) -> None:
+        async with entry.lock:
+            # Someone may have started using the character while we waited for the lock
+            if entry.character is not None and (entry.stale or entry.removed) and entry.in_use == 0:
+                await self._teardown(entry)
+
+    async def _reap_idle(self) -> None:
+        deadline = time.monotonic() - self._idle_timeout
+
+        for entry in list(self._entries.values()):
+            if entry.character is not None and entry.in_use == 0 and entry.last_used < deadline:
+                async with entry.lock:
+                    if entry.character is not None and entry.in_use == 0 and entry.last_used < deadline:
+                        await self._teardown(entry)
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self._poll_interval)
+
+            try:
+                if os.stat(self._filepath).st_mtime != self._mtime:
+                    self.load()
+            except (OSError, ValueError) as e:
+                # Keep the characters we have until the file is fixed
+                self._log(f"Could not reload {self._filepath}: {e}")
+
+            if self._idle_timeout > 0:
+                await self._reap_idle()
+
+    @staticmethod
+    def _log(*args) -> None:
+        print("[CharacterRegistry]", *args)
@@ -1,96 +1,497 @@
+import math
+import time
 import uvicorn
-import threading
-import csv
-from fastapi import FastAPI, Response, status, Body, HTTPException
-from onscreencharacter import OnScreenCharacter
-from queue import Queue
-from typing import Annotated
+import asyncio
+import json
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, Request, Response, status, Body, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from pydantic import BaseModel, ValidationError
+from oscapi import Job, JobStatus, JobTracker, JobQueue, DurableJobQueue, CharacterRegistry, UnknownCharacter
+from src.config import get_config
+from src.llm import NoBackendAvailable, get_backend_status, monitor_backends
+from src.telemetry import metrics
+from src.usage import UsageLedger, UsageLimits
+from typing import Annotated, Any, AsyncIterator, Optional
 
-app = FastAPI()
+# Most items a single batch request may hold, and the longest line accepted by the NDJSON ingest
+MAX_BATCH_ITEMS = 500
+MAX_LINE_BYTES = 64 * 1024
+
+# Seconds clients are told to wait when the queue is full
+QUEUE_FULL_RETRY_SECONDS = 5
+
+
+class ChatItem(BaseModel):
+    """
+    A message for a character, as sent to the batch endpoints.
+    """
+    character: str
+    message: str
+    submitter: str | None = None
+    priority: int = 0
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    config = get_config()
+    init_app_state()
+    await app.state.characters.start()
+
+    # Single worker task that drains the queue so characters speak one at a time
+    app.state.worker = asyncio.create_task(supervise_worker(app.state.chat_queue))
+    app.state.health_monitor = asyncio.create_task(monitor_backends(config.llm_health_interval))
+    yield
+
+    for task in (app.state.worker, app.state.health_monitor):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    # A job cut off here is still in the durable queue and is played again on the next start
+    app.state.chat_queue.close()
+    await app.state.characters.stop()
+
+    if config.api_usage_file is not None:
+        app.state.usage.save(config.api_usage_file)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(UnknownCharacter)
+async def unknown_character_handler(request: Request, exc: UnknownCharacter) -> JSONResponse:
+    # The character was removed from the file after the request was validated
+    return JSONResponse(status_code=404, content={"detail": str(exc)})
 
 
 @app.post("/api/{osc}/chat", status_code=status.HTTP_202_ACCEPTED)
-def api_chat(osc: str, message: Annotated[str, Body()]) -> dict[str, int]:
-    osc = osc.lower()
-    if osc not in app.state.characters:
-        raise HTTPException(status_code=404, detail=f"OSC {osc} does not exist.")
+async def api_chat(osc: str, message: Annotated[str, Body()], request: Request,
+                   submitter: str | None = None, priority: int = 0) -> dict[str, int | str]:
+    """
+    Queues a message for a character. The submitter (for example a Discord user ID) is rate limited and charged
+    for the tokens used. It defaults to the client's address, which is rate limited as well. Messages with a higher
+    priority are answered first.
+    """
+    osc = get_character_name(osc)
+    submitter = check_rate_limit(submitter, request)
 
     # Add message to the queue to be processed
-    app.state.chat_queue.put((osc, message))
-    return {"Queue Position": app.state.chat_queue.qsize()}
+    job = app.state.jobs.create(osc, message, submitter, priority)
+    app.state.chat_queue.put(job)
+
+    # Connect the character while the job waits in the queue
+    app.state.characters.warm_up(osc)
+    return {"Queue Position": app.state.chat_queue.position(job), "Job ID": job.id}
+
+
+@app.post("/api/chat/batch")
+async def api_chat_batch(items: Annotated[list[Any], Body()], request: Request,
+                         atomic: bool = False) -> dict[str, list[dict] | int]:
+    """
+    Queues many messages in one request. Every item is validated before any is queued, and the accepted ones are
+    queued together so no other request can come between them. Returns a result per item, in the order given.
+    If atomic is set, nothing is queued unless every item is accepted.
+    """
+    if len(items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {MAX_BATCH_ITEMS} items.")
+
+    results = enqueue_items(items, request, atomic)
+    return {"Results": results, "Queue Length": app.state.chat_queue.qsize()}
+
+
+@app.post("/api/chat/stream")
+async def api_chat_stream(request: Request) -> Response:
+    """
+    Queues messages sent as newline delimited JSON, one item per line, as soon as each line arrives. Responds with
+    a newline delimited JSON result per line once the request body ends. Lines that cannot be read also report how
+    many items before them were queued.
+    """
+    results = []
+    line_no = 0
+    accepted = 0
+
+    async for line in read_lines(request.stream(), MAX_LINE_BYTES):
+        line_no += 1
+
+        if line is None:
+            result = {"Status": 413, "Detail": f"Lines can be at most {MAX_LINE_BYTES} bytes long."}
+        elif not line.strip():
+            continue
+        else:
+            # Covers lines that are not UTF-8 as well as invalid JSON
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                result = {"Status": 400, "Detail": f"Invalid JSON: {e}", "Accepted": accepted}
+            else:
+                result = enqueue_items([item], request)[0]
+                accepted += result["Status"] == 202
+
+        results.append({"Line": line_no, **result})
+
+    return Response("".join(json.dumps(result) + "\n" for result in results), media_type="application/x-ndjson")
 
 
 @app.put("/api/{osc}/messages", status_code=status.HTTP_204_NO_CONTENT)
-def api_replace_messages(osc: str, messages: list[dict[str, str]] | None = None) -> None:
+async def api_replace_messages(osc: str, messages: list[dict[str, str]] | None = None) -> None:
     """
     Replaces the message history of a certain onscreen character with a new history
     """
-    app.state.characters[osc].set_message_history(messages)
+    async with app.state.characters.use(get_character_name(osc)) as character:
+        with llm_unavailable_as_503():
+            await character.set_message_history(messages)
 
 
 @app.put("/api/{osc}/sysmsg", status_code=status.HTTP_200_OK)
-def api_replace_system_message(osc: str, system_message: Annotated[str | None, Body()] = None) -> dict[str, int]:
+async def api_replace_system_message(osc: str,
+                                     system_message: Annotated[str | None, Body()] = None) -> dict[str, int]:
     """
     Replaces the system message of a certain onscreen character, returning the number of tokens present in the new msg.
     """
-    tokens = app.state.characters[osc].set_system_message(system_message)
+    async with app.state.characters.use(get_character_name(osc)) as character:
+        with llm_unavailable_as_503():
+            tokens = await character.set_system_message(system_message)
+
     return {"System Message Tokens": tokens}
 
 
 @app.get("/api/{osc}/messages")
-def api_get_messages(osc: str) -> list[dict[str, str]]:
+async def api_get_messages(osc: str) -> list[dict[str, str]]:
     """
-    Gets the message history of a certain onscreen character.
+    Gets the message history of a certain onscreen character. Works while the LLM API is down.
     """
-    return app.state.characters[osc].get_message_history()
+    async with app.state.characters.use(get_character_name(osc)) as character:
+        return await character.get_message_history()
 
 
 @app.get("/api/characters")
-def api_get_characters() -> list[str]:
+async def api_get_characters() -> list[str]:
     """
     Gets names of all characters that can be used through the API.
     """
-    return list(app.state.characters.keys())
+    return app.state.characters.names
 
 
 @app.get("/api/queue")
-def api_get_queue() -> int:
+async def api_get_queue() -> int:
     """
     Returns the length of the processing queue
     """
     return app.state.chat_queue.qsize()
 
 
+@app.get("/api/llm/backends")
+async def api_get_llm_backends() -> list[dict[str, int | bool | str]]:
+    """
+    Returns the outstanding requests, consecutive failures and health of every LLM backend the characters are
+    routed over. Empty when the characters use a single API.
+    """
+    return get_backend_status()
+
+
+@app.get("/api/queue/dead")
+async def api_get_dead_letters(limit: int = 100) -> list[dict]:
+    """
+    Returns the jobs that failed on every attempt, most recent first.
+    """
+    return get_durable_queue().get_dead_letters(limit)
+
+
+@app.post("/api/queue/dead/{job_id}/retry", status_code=status.HTTP_202_ACCEPTED)
+async def api_retry_dead_letter(job_id: str) -> dict[str, int | str]:
+    """
+    Queues a job that failed on every attempt again.
+    """
+    job = get_durable_queue().retry_dead_letter(job_id, app.state.jobs)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} is not a dead letter.")
+
+    return {"Queue Position": app.state.chat_queue.position(job), "Job ID": job.id}
+
+
+@app.get("/api/jobs/{job_id}")
+async def api_get_job(job_id: str) -> dict:
+    """
+    Gets the status of a queued prompt, its generated text once available and how long each stage took.
+    """
+    return get_job(job_id).to_dict()
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def api_job_events(job_id: str) -> StreamingResponse:
+    """
+    Streams the state transitions of a queued prompt as server-sent events, ending once the job finishes.
+    """
+    job = get_job(job_id)
+
+    async def event_stream():
+        async for event in job.events():
+            yield f"event: status\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/api/usage")
+async def api_get_usage() -> dict[str, dict[str, dict[str, int]]]:
+    """
+    Returns the LLM tokens used per submitter, per character and per model.
+    """
+    return app.state.usage.to_dict()
+
+
+@app.get("/metrics")
+async def api_metrics() -> PlainTextResponse:
+    """
+    Exposes the recorded timings and counters in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.REGISTRY.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+def get_job(job_id: str) -> Job:
+    """
+    Gets a tracked job, raising a 404 if it does not exist or has been forgotten.
+    """
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} does not exist.")
+
+    return job
+
+
+def check_rate_limit(submitter: str | None, request: Request, pending: int = 0) -> str:
+    """
+    Raises a 503 if the queue is full, counting pending jobs about to be queued along with this one. Otherwise
+    raises a 429 if the client or the submitter has to wait before queueing more work. The client is limited by its
+    address, as clients can name any submitter. Returns who the work is attributed to.
+    """
+    max_pending = get_config().queue_max_pending
+    if max_pending is not None and app.state.chat_queue.qsize() + pending >= max_pending:
+        raise HTTPException(status_code=503, headers={"Retry-After": str(QUEUE_FULL_RETRY_SECONDS)},
+                            detail="The queue is full. Try again later.")
+
+    client = get_client_address(request)
+    retry_after = app.state.client_limits.check(client)
+    if retry_after > 0:
+        seconds = math.ceil(retry_after)
+        raise HTTPException(status_code=429, headers={"Retry-After": str(seconds)},
+                            detail=f"Too many prompts from {client}. Try again in {seconds} seconds.")
+
+    if submitter is None:
+        submitter = client
+
+    retry_after = app.state.limits.check(submitter)
+    if retry_after > 0:
+        # Not queued, so it does not count against the client either
+        app.state.client_limits.refund(client)
+
+        seconds = math.ceil(retry_after)
+        raise HTTPException(status_code=429, headers={"Retry-After": str(seconds)},
+                            detail=f"Too many prompts from {submitter}. Try again in {seconds} seconds.")
+
+    return submitter
+
+
+def get_client_address(request: Request) -> str:
+    return request.client.host if request.client is not None else "unknown"
+
+
+def get_character_name(osc: str) -> str:
+    """
+    Normalizes a character name from a request, raising a 404 if the character does not exist.
+    """
+    osc = osc.lower()
+    if osc not in app.state.characters:
+        raise HTTPException(status_code=404, detail=f"OSC {osc} does not exist.")
+
+    return osc
+
+
+def enqueue_items(items: list, request: Request, atomic: bool = False) -> list[dict]:
+    """
+    Validates chat items and queues the accepted ones all at once, returning a result for each item. If atomic is
+    set, nothing is queued unless every item is accepted.
+    """
+    results: list[dict] = []
+    accepted: list[tuple[int, ChatItem, str, str]] = []
+
+    for idx, item in enumerate(items):
+        try:
+            chat = ChatItem.model_validate(item)
+            osc = get_character_name(chat.character)
+            submitter = check_rate_limit(chat.submitter, request, pending=len(accepted))
+        except ValidationError as e:
+            results.append({"Status": 422, "Detail": format_validation_error(e)})
+        except HTTPException as e:
+            result = {"Status": e.status_code, "Detail": e.detail}
+            if e.headers is not None and "Retry-After" in e.headers:
+                result["Retry After"] = int(e.headers["Retry-After"])
+
+            results.append(result)
+        else:
+            results.append({})
+            accepted.append((idx, chat, osc, submitter))
+
+    if atomic and len(accepted) < len(items):
+        for idx, _, _, submitter in accepted:
+            app.state.limits.refund(submitter)
+            app.state.client_limits.refund(get_client_address(request))
+            results[idx] = {"Status": 409, "Detail": "Not queued as another item in the batch was rejected."}
+
+        return results
+
+    jobs = [app.state.jobs.create(osc, chat.message, submitter, chat.priority) for _, chat, osc, submitter in accepted]
+    app.state.chat_queue.put_many(jobs)
+
+    for (idx, _, _, _), job in zip(accepted, jobs):
+        results[idx] = {"Status": 202, "Job ID": job.id}
+
+    for osc in {job.character for job in jobs}:
+        app.state.characters.warm_up(osc)
+
+    return results
+
+
+def format_validation_error(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(loc) for loc in err['loc']) or 'item'}: {err['msg']}" for err in error.errors())
+
+
+async def read_lines(chunks: AsyncIterator[bytes], max_length: int) -> AsyncIterator[Optional[bytes]]:
+    """
+    Splits a byte stream into lines as the chunks arrive. Lines longer than max_length are skipped and yield None.
+    """
+    buffer = bytearray()
+    too_long = False
+
+    async for chunk in chunks:
+        parts = chunk.split(b"\n")
+
+        for idx, part in enumerate(parts):
+            if idx > 0:
+                # A newline ended the line in the buffer
+                yield None if too_long else bytes(buffer)
+                buffer.clear()
+                too_long = False
+
+            if not too_long:
+                buffer += part
+                if len(buffer) > max_length:
+                    too_long = True
+                    buffer.clear()
+
+    if buffer or too_long:
+        yield None if too_long else bytes(buffer)
+
+
+@contextmanager
+def llm_unavailable_as_503():
+    """
+    Turns errors reaching the LLM API, for example while counting the tokens of a new system message, into a 503.
+    """
+    # Imported here as loading the OpenAI client is slow
+    import openai
+
+    try:
+        yield
+    except (openai.APIConnectionError, NoBackendAvailable) as e:
+        raise HTTPException(status_code=503, detail=f"The LLM API is unavailable: {e}") from e
+
+
+def get_durable_queue() -> DurableJobQueue:
+    if not isinstance(app.state.chat_queue, DurableJobQueue):
+        raise HTTPException(status_code=404, detail="The queue is kept in memory, so failed jobs are not kept.")
+
+    return app.state.chat_queue
+
+
 def init_app_state():
-    app.state.characters = {}
-    app.state.chat_queue = Queue(maxsize=0)  # Infinite queue size
+    config = get_config()
+    metrics.REGISTRY.enabled = config.metrics_enabled
 
-    # Initialize worker thread
-    app.state.worker = threading.Thread(target=talk_char, args=(app.state.chat_queue,), daemon=True)
-    app.state.worker.start()
+    app.state.jobs = JobTracker()
 
-    # Read each character from the csv file
-    with open("characters.csv") as char_csv:
-        csv_reader = csv.reader(char_csv, delimiter=",")
+    # Infinite queue size. Jobs a previous run did not get to are played first.
+    if config.queue_db is not None:
+        app.state.chat_queue = DurableJobQueue(config.queue_db, config.queue_max_attempts, config.queue_retry_delay)
+        recovered = app.state.chat_queue.recover(app.state.jobs)
+        if recovered:
+            print(f"[OSC API] Recovered {len(recovered)} queued jobs from {config.queue_db}.")
+    else:
+        app.state.chat_queue = JobQueue()
 
-        line_no = 0
-        for row in csv_reader:
-            if line_no == 0:
-                assert row == ["character_name", "scene_name", "source_name"]
-            else:
-                app.state.characters[row[0]] = OnScreenCharacter(row[1], row[2])
+    app.state.usage = UsageLedger()
+    if config.api_usage_file is not None:
+        try:
+            app.state.usage.load(config.api_usage_file, missing_ok=True)
+        except Exception as e:
+            # The file is overwritten when the API stops, so it does not have to be fixed by hand
+            print(f"[OSC API] Could not load the usage totals, starting from zero: {e!r}")
+
+    app.state.limits = UsageLimits.from_config(config)
+    app.state.client_limits = UsageLimits(config.client_rate_limit_burst, config.client_rate_limit_per_minute)
 
-            line_no += 1
+    # Characters are read from the csv file, which is watched for changes while the API runs
+    app.state.characters = CharacterRegistry(config.characters_file, config, idle_timeout=config.character_idle_seconds)
+    app.state.characters.load()
 
 
-def talk_char(q: Queue):
-    # Worker thread to process messages in the queue
+async def supervise_worker(q: JobQueue):
+    # Keeps the worker running, as the queue would silently stall if it ever died
     while True:
-        char_info = q.get()
-        app.state.characters[char_info[0]].talk(char_info[1])
-        q.task_done()
+        try:
+            await talk_char(q)
+        except Exception as e:
+            print(f"[OSC API] The queue worker crashed, restarting it: {e!r}")
+            await asyncio.sleep(1.0)
+
+
+async def talk_char(q: JobQueue):
+    # Worker task to process messages in the queue
+    while True:
+        job: Job = await q.get()
+
+        try:
+            metrics.QUEUE_WAIT_SECONDS.observe(time.time() - job.timestamps[JobStatus.QUEUED.value])
+
+            async with app.state.characters.use(job.character) as character:
+                # A retried job that was answered before only has to be spoken again
+                if job.text is None:
+                    job.set_status(JobStatus.GENERATING)
+                    text, usage = await character.ask(job.message)
+
+                    # Charged right away, as the answer is kept even if speaking it fails
+                    app.state.usage.record(usage, user=job.submitter, character=job.character,
+                                           model=character.model_name)
+                    app.state.limits.charge_tokens(job.submitter, usage)
+                    job.set_status(JobStatus.SYNTHESIZING, text=text)
+
+                await character.speak(job.text, on_stage=job.set_status)
+        except Exception as e:
+            fail_job(q, job, e)
+            continue
+
+        # Acknowledged as soon as it has been played, so it is never played twice
+        q.ack(job)
+        job.set_status(JobStatus.DONE)
+        metrics.PROMPTS_TOTAL.inc(status=JobStatus.DONE.value)
+
+
+def fail_job(q: JobQueue, job: Job, error: Exception):
+    # A character that was removed from the csv file will not come back by retrying
+    retry = not isinstance(error, UnknownCharacter)
+
+    if q.nack(job, str(error), retry):
+        print(f"[OSC API] Job {job.id} for {job.character} failed, retrying it: {error}")
+        job.requeue(str(error))
+        metrics.PROMPTS_TOTAL.inc(status="retried")
+    else:
+        print(f"[OSC API] Job {job.id} for {job.character} failed: {error}")
+        job.set_status(JobStatus.FAILED, error=str(error))
+        metrics.PROMPTS_TOTAL.inc(status=JobStatus.FAILED.value)
 
 
 if __name__ == "__main__":
-    init_app_state()
     uvicorn.run(app, host="localhost", port=8000)
@@ -0,0 +1,4 @@
+__all__ = ["Counter", "Histogram", "MetricsRegistry", "REGISTRY", "metrics"]
+
+from .metrics import Counter, Histogram, MetricsRegistry, REGISTRY
+from . import metrics
@@ -0,0 +1,278 @@
+"""
+Lightweight counters and histograms for timing the hot paths, exposed in the Prometheus text format.
+
+Every metric checks REGISTRY.enabled before doing any work, so instrumentation costs a single attribute lookup
+when metrics are turned off.
+"""
+import math
+import time
+import bisect
+import threading
+from typing import Optional
+
+# Bucket upper bounds in seconds, spanning a fast OBS round-trip up to a long LLM generation
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class MetricsRegistry:
+    """
+    Holds every metric created in a process.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self._metrics: dict[str, "Counter | Histogram"] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()) -> "Counter":
+        return self._register(Counter(self, name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> "Histogram":
+        return self._register(Histogram(self, name, help_text, labelnames, buckets))
+
+    def _register(self, metric):
+        # Creating a metric twice gives back the first one, so modules can be imported more than once
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render_prometheus(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        Returns a summary of every metric that has been recorded, keyed by metric name and labels.
+        """
+        summary = {}
+        for metric in list(self._metrics.values()):
+            summary.update(metric.summarize())
+
+        return summary
+
+
+class _Metric:
+    kind: str = ""
+
+    def __init__(self, registry: MetricsRegistry, name: str, help_text: str, labelnames: tuple[str, ...]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._registry = registry
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(labelname, "")) for labelname in self.labelnames)
+
+    def _format_labels(self, key: tuple[str, ...], extra: Optional[dict[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, such as the number of requests made.
+    """
+    kind = "counter"
+
+    def __init__(self, registry: MetricsRegistry, name: str, help_text: str, labelnames: tuple[str, ...]) -> None:
+        super().__init__(registry, name, help_text, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        if not self._registry.enabled:
+            return
+
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for key, value in list(self._values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {_format_value(value)}")
+
+        return lines
+
+    def summarize(self) -> dict[str, dict]:
+        return {self.name + self._format_labels(key): {"value": value} for key, value in list(self._values.items())}
+
+
+class Histogram(_Metric):
+    """
+    Counts observed durations into buckets so percentiles can be estimated without storing every sample.
+    """
+    kind = "histogram"
+
+    def __init__(self, registry: MetricsRegistry, name: str, help_text: str, labelnames: tuple[str, ...],
+                 buckets: tuple[float, ...]) -> None:
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        # Per label values: [count in each bucket (plus one for +Inf), sum, count]
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        if not self._registry.enabled:
+            return
+
+        key = self._key(labels)
+        bucket_idx = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            state[0][bucket_idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels: str) -> "_Timer | _NullTimer":
+        """
+        Observes how long the body of the with statement takes.
+        """
+        if not self._registry.enabled:
+            return _NULL_TIMER
+
+        return _Timer(self, labels)
+
+    def quantile(self, q: float, **labels: str) -> float:
+        """
+        Estimates a quantile (0.0-1.0) by interpolating inside the bucket it falls in, like Prometheus does.
+        """
+        state = self._values.get(self._key(labels))
+        if state is None or state[2] == 0:
+            return math.nan
+
+        return _bucket_quantile(self.buckets, state[0], state[2], q)
+
+    def render(self) -> list[str]:
+        lines = self._header()
+
+        for key, (bucket_counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets + (math.inf,), bucket_counts):
+                cumulative += bucket_count
+                le = {"le": "+Inf" if upper == math.inf else _format_value(upper)}
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}")
+
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+
+        return lines
+
+    def summarize(self) -> dict[str, dict]:
+        summary = {}
+
+        for key, (bucket_counts, total, count) in list(self._values.items()):
+            summary[self.name + self._format_labels(key)] = {
+                "count": count,
+                "mean": total / count if count else math.nan,
+                "p50": _bucket_quantile(self.buckets, bucket_counts, count, 0.5),
+                "p95": _bucket_quantile(self.buckets, bucket_counts, count, 0.95),
+                "p99": _bucket_quantile(self.buckets, bucket_counts, count, 0.99)
+            }
+
+        return summary
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labels", "_start")
+
+    def __init__(self, histogram: Histogram, labels: dict[str, str]) -> None:
+        self._histogram = histogram
+        self._labels = labels
+        self._start = 0.0
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+class _NullTimer:
+    """
+    Handed out while metrics are disabled so timing a block costs next to nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _bucket_quantile(buckets: tuple[float, ...], bucket_counts: list[int], count: int, q: float) -> float:
+    if count == 0:
+        return math.nan
+
+    rank = q * count
+    cumulative = 0
+
+    for idx, bucket_count in enumerate(bucket_counts):
+        if cumulative + bucket_count >= rank and bucket_count > 0:
+            # Anything past the last bucket is reported as the last bucket's bound
+            if idx == len(buckets):
+                return buckets[-1]
+
+            lower = buckets[idx - 1] if idx > 0 else 0.0
+            return lower + (buckets[idx] - lower) * (rank - cumulative) / bucket_count
+
+        cumulative += bucket_count
+
+    return buckets[-1]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+REGISTRY = MetricsRegistry()
+
+# Metrics recorded along the path of a prompt. They live here so every process defines them the same way.
+QUEUE_WAIT_SECONDS = REGISTRY.histogram("aichar_queue_wait_seconds",
+                                        "Time a prompt spent in the queue before being worked on.")
+PROMPTS_TOTAL = REGISTRY.counter("aichar_prompts_total", "Prompts processed by the queue worker.", ("status",))
+TOKEN_COUNT_SECONDS = REGISTRY.histogram("aichar_llm_token_count_seconds",
+                                         "Time taken by a single token counting request.")
+LLM_TIME_TO_FIRST_TOKEN_SECONDS = REGISTRY.histogram("aichar_llm_time_to_first_token_seconds",
+                                                     "Time until the first piece of a response arrived, the whole "
+                                                     "response time when it is not streamed.", ("backend",))
+LLM_REQUEST_SECONDS = REGISTRY.histogram("aichar_llm_request_seconds",
+                                         "Time taken to generate a full response, trimming excluded.", ("backend",))
+LLM_REQUESTS_TOTAL = REGISTRY.counter("aichar_llm_requests_total", "Responses requested from an LLM.",
+                                      ("backend", "status"))
+LLM_FAILOVERS_TOTAL = REGISTRY.counter("aichar_llm_failovers_total",
+                                       "Requests handed to a backend after the previous one failed or timed out.",
+                                       ("backend",))
+TTS_SECONDS = REGISTRY.histogram("aichar_tts_synth_seconds", "Time taken to synthesize speech for a response.")
+AUDIO_PROCESSING_SECONDS = REGISTRY.histogram("aichar_audio_processing_seconds",
+                                              "Time taken to decode and post-process synthesized speech.")
+OBS_REQUEST_SECONDS = REGISTRY.histogram("aichar_obs_request_seconds", "Time taken by an OBS websocket round-trip.",
+                                         ("request",))
+PLAYBACK_SECONDS = REGISTRY.histogram("aichar_playback_seconds", "Time spent playing a response out loud.")
@@ -0,0 +1,4 @@
+__all__ = ["UsageLedger", "UsageTotals", "TokenBucket", "RateLimiter", "UsageLimits"]
+
+from .ledger import UsageLedger, UsageTotals
+from .ratelimit import TokenBucket, RateLimiter, UsageLimits
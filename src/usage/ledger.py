@@ -0,0 +1,100 @@
+import os
+import json
+import threading
+from typing import Optional
+from dataclasses import dataclass, asdict
+
+# What usage is aggregated by
+DIMENSIONS = ("user", "character", "model")
+
+
+@dataclass
+class UsageTotals:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+class UsageLedger:
+    """
+    Aggregates the token usage returned by the LLM managers per user, per character and per model.
+    """
+
+    def __init__(self) -> None:
+        self._totals: dict[str, dict[str, UsageTotals]] = {dimension: {} for dimension in DIMENSIONS}
+        self._lock = threading.Lock()
+
+    def record(self, usage: dict[str, int], user: Optional[str] = None, character: Optional[str] = None,
+               model: Optional[str] = None) -> None:
+        """
+        Adds the usage of a single request to the totals of everything it is attributed to.
+
+        :param usage: The token usage info returned by an LLM manager's ask.
+        :param user: Who made the request, if known.
+        :param character: Which character answered the request, if any.
+        :param model: Which model answered the request, if known.
+        """
+        prompt_tokens = int(usage.get("prompt_tokens", 0) or 0)
+        completion_tokens = int(usage.get("completion_tokens", 0) or 0)
+
+        with self._lock:
+            for dimension, key in zip(DIMENSIONS, (user, character, model)):
+                if key is None:
+                    continue
+
+                totals = self._totals[dimension].setdefault(str(key), UsageTotals())
+                totals.requests += 1
+                totals.prompt_tokens += prompt_tokens
+                totals.completion_tokens += completion_tokens
+
+    def get(self, dimension: str, key: str) -> UsageTotals:
+        """
+        Gets a copy of the totals for one user, character or model. Unknown keys have no usage.
+        """
+        totals = self._totals[dimension].get(str(key))
+        return UsageTotals(**asdict(totals)) if totals is not None else UsageTotals()
+
+    def to_dict(self) -> dict[str, dict[str, dict[str, int]]]:
+        """
+        Returns every total, grouped by dimension.
+        """
+        with self._lock:
+            return {dimension: {key: dict(asdict(totals), total_tokens=totals.total_tokens)
+                                for key, totals in keyed.items()}
+                    for dimension, keyed in self._totals.items()}
+
+    def save(self, filepath: str) -> None:
+        """
+        Saves the totals into a JSON file. The file is replaced in one go, so a crash while saving keeps the old one.
+        """
+        temp_path = f"{filepath}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, ensure_ascii=False, indent=4)
+
+        os.replace(temp_path, filepath)
+
+    def load(self, filepath: str, missing_ok: bool = False) -> None:
+        """
+        Replaces the totals with ones previously saved into a JSON file.
+
+        :param filepath: The file written by save.
+        :param missing_ok: Keeps the current totals instead of raising FileNotFoundError if the file does not exist,
+                           for example on the first run.
+        """
+        try:
+            with open(filepath, "r", encoding="utf-8") as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            if missing_ok:
+                return
+            raise
+
+        with self._lock:
+            for dimension in DIMENSIONS:
+                self._totals[dimension] = {key: UsageTotals(values["requests"], values["prompt_tokens"],
+                                                            values["completion_tokens"])
+                                           for key, values in saved.get(dimension, {}).items()}
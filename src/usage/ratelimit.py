@@ -0,0 +1,162 @@
+import time
+import threading
+from typing import Optional
+from collections import OrderedDict
+from ..config import Config
+
+
+class TokenBucket:
+    """
+    Classic token bucket. Holds up to capacity tokens and regains refill_rate tokens every second.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float) -> None:
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_rate)
+        self._updated = now
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """
+        Returns how many seconds until amount tokens are available, without taking them.
+        """
+        self._refill(time.monotonic())
+
+        if self.tokens >= amount:
+            return 0.0
+
+        if self.refill_rate <= 0:
+            return float("inf")
+
+        return (amount - self.tokens) / self.refill_rate
+
+    def try_acquire(self, amount: float = 1.0) -> float:
+        """
+        Takes amount tokens if they are available. Returns 0.0 if they were taken, otherwise how many seconds to
+        wait until they would be.
+        """
+        wait = self.wait_time(amount)
+
+        if wait == 0.0:
+            self.tokens -= amount
+
+        return wait
+
+    def charge(self, amount: float) -> None:
+        """
+        Takes amount tokens even if they are not available, going into debt that has to be refilled first.
+        Used for costs only known after the work is done.
+        """
+        self._refill(time.monotonic())
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    Keeps a token bucket per key (such as a Discord user). Only the most recently used max_keys buckets are kept,
+    forgetting a bucket is the same as it being full.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float, max_keys: int = 10000) -> None:
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._max_keys = max_keys
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.capacity, self.refill_rate)
+
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+
+        return bucket
+
+    def try_acquire(self, key: str, amount: float = 1.0) -> float:
+        """
+        Takes amount tokens from key's bucket. Returns 0.0 if allowed, otherwise seconds until it would be.
+        """
+        with self._lock:
+            return self._get_bucket(str(key)).try_acquire(amount)
+
+    def charge(self, key: str, amount: float) -> None:
+        with self._lock:
+            self._get_bucket(str(key)).charge(amount)
+
+    def wait_time(self, key: str, amount: float = 1.0) -> float:
+        """
+        Returns how many seconds until key's bucket has amount tokens, without taking them.
+        """
+        with self._lock:
+            bucket = self._buckets.get(str(key))
+            return bucket.wait_time(amount) if bucket is not None else 0.0
+
+
+class UsageLimits:
+    """
+    The limits applied to each user before their work is queued: how many prompts they may send in a burst and per
+    minute, and optionally how many LLM tokens they may use per hour.
+    """
+
+    def __init__(self, prompt_burst: int = 3, prompts_per_minute: float = 6.0,
+                 tokens_per_hour: Optional[int] = None) -> None:
+        """
+        :param prompt_burst: How many prompts a user can send back to back.
+        :param prompts_per_minute: How quickly a user regains prompts. Set to 0 or less to disable prompt limits.
+        :param tokens_per_hour: LLM tokens (prompt + completion) a user may use every hour. None for no budget.
+        """
+        self._prompts: Optional[RateLimiter] = None
+        self._tokens: Optional[RateLimiter] = None
+
+        if prompts_per_minute > 0:
+            self._prompts = RateLimiter(prompt_burst, prompts_per_minute / 60)
+
+        if tokens_per_hour is not None and tokens_per_hour > 0:
+            self._tokens = RateLimiter(tokens_per_hour, tokens_per_hour / 3600)
+
+    @classmethod
+    def from_config(cls, config: Config) -> "UsageLimits":
+        """
+        Creates the limits from the AI_RATE_LIMIT_BURST, AI_RATE_LIMIT_PER_MINUTE and AI_TOKEN_BUDGET_PER_HOUR
+        settings.
+        """
+        return cls(config.rate_limit_burst, config.rate_limit_per_minute, config.token_budget_per_hour)
+
+    def check(self, key: str) -> float:
+        """
+        Checks whether key may submit another prompt, taking one from its prompt allowance if so.
+        Returns 0.0 if allowed, otherwise how many seconds to wait before trying again.
+        """
+        if self._tokens is not None:
+            # Requests are allowed until the budget is used up, their real cost is charged afterwards
+            retry_after = self._tokens.wait_time(key, 0.0)
+            if retry_after > 0:
+                return retry_after
+
+        if self._prompts is not None:
+            return self._prompts.try_acquire(key)
+
+        return 0.0
+
+    def refund(self, key: str) -> None:
+        """
+        Gives back the prompt check took from key, for prompts that ended up not being queued.
+        """
+        if self._prompts is not None:
+            self._prompts.charge(key, -1)
+
+    def charge_tokens(self, key: str, usage: dict[str, int]) -> None:
+        """
+        Charges the tokens a finished request used to key's hourly budget.
+        """
+        if self._tokens is not None:
+            self._tokens.charge(key, int(usage.get("total_tokens", 0) or 0))
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pytest
+
+# Lets the mixer open without a sound card
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+pygame = pytest.importorskip("pygame")
+
+from src.onscreencharacter.audiomanager import AudioManager
+from src.onscreencharacter.audioprocessing import ProcessedAudio, match_channels
+
+
+@pytest.fixture(params=[1, 2])
+def mixer_channels(request):
+    pygame.mixer.quit()
+    pygame.mixer.init(frequency=22050, size=-16, channels=request.param)
+    yield request.param
+    pygame.mixer.quit()
+
+
+def tone(channels: int, sample_rate: int = 22050, seconds: float = 0.05) -> ProcessedAudio:
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    wave = (np.sin(2 * np.pi * 440 * t) * 10000).astype(np.int16)
+    samples = np.repeat(wave[:, None], channels, axis=1)
+
+    return ProcessedAudio(samples, sample_rate, np.zeros(0, dtype=np.float32))
+
+
+@pytest.mark.parametrize("clip_channels", [1, 2])
+def test_play_audio_matches_mixer_channels(mixer_channels, clip_channels):
+    progress = []
+
+    # Raised "Array must be 1-dimensional for mono mixer" before clips were mixed to the mixer's channels
+    AudioManager().play_audio(tone(clip_channels), on_progress=progress.append)
+
+    assert pygame.mixer.get_init()[2] == mixer_channels
+    assert len(progress) > 0
+
+
+@pytest.mark.parametrize("clip_channels, channels, shape", [(1, 1, (10,)), (2, 1, (10,)), (1, 2, (10, 2)),
+                                                            (2, 2, (10, 2))])
+def test_match_channels_shape(clip_channels, channels, shape):
+    samples = np.full((10, clip_channels), 100, dtype=np.int16)
+
+    mixed = match_channels(samples, channels)
+
+    assert mixed.shape == shape
+    assert mixed.dtype == np.int16
+    assert np.all(mixed == 100)
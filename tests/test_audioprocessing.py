@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from src.onscreencharacter.audioprocessing import AudioProcessor, trim_silence, window_levels
+
+
+@pytest.mark.parametrize("channels", [1, 2])
+def test_process_samples_empty_clip(channels):
+    samples = np.zeros((0, channels), dtype=np.int16)
+
+    audio = AudioProcessor().process_samples(samples, 22050)
+
+    assert audio.samples.shape == (0, channels)
+    assert audio.samples.dtype == np.int16
+    assert len(audio.envelope) == 0
+    assert audio.duration == 0.0
+
+
+def test_empty_clip_helpers():
+    audio = np.zeros((0, 2), dtype=np.float32)
+
+    assert len(window_levels(audio, 441)) == 0
+    assert trim_silence(audio, 22050, -50.0, 0.05) is audio
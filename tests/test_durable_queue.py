@@ -0,0 +1,129 @@
+import asyncio
+
+from oscapi import Job, JobTracker, DurableJobQueue
+
+
+def make_jobs(*messages: str, priority: int = 0) -> list[Job]:
+    return [Job("steve", message, "tester", priority) for message in messages]
+
+
+def test_recover_keeps_order_and_attempts(tmp_path):
+    path = str(tmp_path / "queue.db")
+
+    async def first_run():
+        queue = DurableJobQueue(path)
+        queue.put_many(make_jobs("a", "b", "c"))
+
+        # Taken but never acked, as if the API crashed while playing it
+        taken = await queue.get()
+        queue.close()
+        return taken
+
+    taken = asyncio.run(first_run())
+
+    async def second_run():
+        queue = DurableJobQueue(path)
+        tracker = JobTracker()
+        recovered = queue.recover(tracker)
+        attempts = [job.attempts for job in recovered]
+        queued = [await queue.get() for _ in range(queue.qsize())]
+        queue.close()
+        return recovered, attempts, queued, tracker
+
+    recovered, attempts, queued, tracker = asyncio.run(second_run())
+
+    assert [job.message for job in recovered] == ["a", "b", "c"]
+    assert [job.message for job in queued] == ["a", "b", "c"]
+    assert recovered[0].id == taken.id
+    assert attempts == [1, 0, 0]
+    assert all(tracker.get(job.id) is job for job in recovered)
+
+
+def test_nack_retries_then_moves_to_dead_letters(tmp_path):
+    async def run():
+        queue = DurableJobQueue(str(tmp_path / "queue.db"), max_attempts=2, retry_delay=0.01)
+        queue.put(make_jobs("a")[0])
+
+        job = await queue.get()
+        retried = queue.nack(job, "first failure")
+        job = await asyncio.wait_for(queue.get(), 1.0)
+        dead = not queue.nack(job, "second failure")
+
+        dead_letters = queue.get_dead_letters()
+        queue.close()
+        return retried, dead, job, dead_letters
+
+    retried, dead, job, dead_letters = asyncio.run(run())
+
+    assert retried
+    assert dead
+    assert job.attempts == 2
+    assert [(letter["id"], letter["attempts"], letter["error"]) for letter in dead_letters] == \
+        [(job.id, 2, "second failure")]
+
+
+def test_nack_without_retry_is_dead_right_away(tmp_path):
+    async def run():
+        queue = DurableJobQueue(str(tmp_path / "queue.db"), max_attempts=3)
+        queue.put(make_jobs("a")[0])
+
+        job = await queue.get()
+        retried = queue.nack(job, "unknown character", retry=False)
+        result = retried, queue.qsize(), len(queue.get_dead_letters())
+        queue.close()
+        return result
+
+    assert asyncio.run(run()) == (False, 0, 1)
+
+
+def test_recover_moves_used_up_jobs_to_dead_letters(tmp_path):
+    path = str(tmp_path / "queue.db")
+
+    async def first_run():
+        queue = DurableJobQueue(path, max_attempts=1)
+        queue.put_many(make_jobs("crashes", "waits"))
+        await queue.get()
+        queue.close()
+
+    asyncio.run(first_run())
+
+    queue = DurableJobQueue(path, max_attempts=1)
+    recovered = queue.recover(JobTracker())
+    dead_letters = queue.get_dead_letters()
+    queue.close()
+
+    assert [job.message for job in recovered] == ["waits"]
+    assert [letter["message"] for letter in dead_letters] == ["crashes"]
+
+
+def test_retry_dead_letter(tmp_path):
+    path = str(tmp_path / "queue.db")
+
+    async def run():
+        queue = DurableJobQueue(path, max_attempts=1)
+        tracker = JobTracker()
+        queue.put(make_jobs("a", priority=4)[0])
+
+        job = await queue.get()
+        queue.nack(job, "failure")
+
+        retried = queue.retry_dead_letter(job.id, tracker)
+        missing = queue.retry_dead_letter("no-such-job", tracker)
+        result = job, retried, missing, queue.get_dead_letters(), queue.position(retried), tracker.get(job.id)
+        queue.close()
+        return result
+
+    job, retried, missing, dead_letters, position, tracked = asyncio.run(run())
+
+    assert missing is None
+    assert dead_letters == []
+    assert (retried.id, retried.message, retried.priority, retried.attempts) == (job.id, "a", 4, 0)
+    assert position == 1
+    assert tracked is retried
+
+    # Reset in the database as well, so a restart recovers it with all its attempts
+    queue = DurableJobQueue(path, max_attempts=1)
+    recovered = queue.recover(JobTracker())
+    queue.close()
+
+    assert [(job.id, job.attempts) for job in recovered] == [(retried.id, 0)]
@@ -0,0 +1,72 @@
+import random
+import asyncio
+
+from oscapi import Job, JobQueue, JobStatus, JobTracker
+
+
+def expected_positions(queue: JobQueue) -> dict[str, int]:
+    # The heap entries sort in the order the jobs are handed out
+    return {job.id: idx + 1 for idx, (_, _, job) in enumerate(sorted(queue._heap))}
+
+
+def test_position_follows_priority_then_arrival():
+    async def run():
+        queue = JobQueue()
+        low, high, low_again, highest = (Job("steve", str(idx), priority=priority)
+                                         for idx, priority in enumerate((0, 5, 0, 9)))
+        queue.put_many([low, high, low_again, highest])
+
+        before = [queue.position(job) for job in (highest, high, low, low_again)]
+        taken = await queue.get()
+        after = [queue.position(job) for job in (highest, high, low, low_again)]
+        return before, taken, highest, after
+
+    before, taken, highest, after = asyncio.run(run())
+
+    assert before == [1, 2, 3, 4]
+    assert taken is highest
+    assert after == [0, 1, 2, 3]
+
+
+def test_position_matches_heap_order():
+    rng = random.Random(27)
+
+    async def run():
+        queue = JobQueue()
+        queued = []
+
+        for step in range(2000):
+            if queued and rng.random() < 0.45:
+                queued.remove(await queue.get())
+            else:
+                job = Job("steve", str(step), priority=rng.choice((-1, 0, 0, 1, 5)))
+                queue.put(job)
+                queued.append(job)
+
+            if step % 25 == 0:
+                expected = expected_positions(queue)
+                assert {job.id: queue.position(job) for job in queued} == expected
+
+        assert queue.position(Job("steve", "never queued")) == 0
+
+    asyncio.run(run())
+
+
+def test_tracker_forgets_jobs_that_finished_longest_ago():
+    tracker = JobTracker(max_finished=2)
+    jobs = [tracker.create("steve", str(idx)) for idx in range(5)]
+
+    for idx in (3, 0, 1):
+        jobs[idx].set_status(JobStatus.DONE)
+
+    assert tracker.get(jobs[3].id) is None
+    assert [tracker.get(job.id) is job for job in jobs] == [True, True, True, False, True]
+
+    # A job tracked again under the same ID is not forgotten when its old copy would have been
+    again = Job("steve", "again", job_id=jobs[0].id)
+    tracker.add(again)
+    jobs[4].set_status(JobStatus.FAILED)
+    jobs[2].set_status(JobStatus.DONE)
+
+    assert tracker.get(jobs[0].id) is again
+    assert tracker.get(jobs[1].id) is None